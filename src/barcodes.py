@@ -14,39 +14,175 @@
 
 
 import gzip
+import hashlib
+import heapq
+import io
+import mmap
+import pickle
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import zlib
 from mimetypes import guess_type
-from functools import partial
+from functools import partial, lru_cache
 import re
 import argparse
 import sys
-from os import path
+from os import path, makedirs, replace
 import yaml
-import pandas as pd
+try:
+	import numpy as np
+except ImportError:
+	np = None
+try:
+	from isal import igzip
+except ImportError:
+	igzip = None
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
 from Bio.Seq import Seq
 from Bio import SeqIO
-import gzip
-from mimetypes import guess_type
-from functools import partial
 import csv
-import pdb
+import multiprocessing
+from itertools import islice, combinations, product, zip_longest
+from math import comb
+from collections import deque, Counter, OrderedDict
+
+# for reverse complmenting (including IUPAC ambiguity codes, as for Bio.Seq.reverse_complement)
+old_chars = "ACTGMRWSYKVHDBNactgmrwsykvhdbn"
+new_chars = "TGACKYWSRMBDHVNtgackywsrmbdhvn"
+tab = str.maketrans(old_chars, new_chars)
+
+# size of read buffer used when parsing fastq files
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# number of blocks of decompressed data that can be waiting to be parsed
+DECOMPRESS_QUEUE_SIZE = 8
+
+# programs and modules that can be used to decompress gzipped input
+DECOMPRESSORS = ['auto', 'pigz', 'isal', 'gzip']
+
+# number of reads in each chunk processed by count_barcodes
+CHUNK_SIZE = 20000
+
+# approximate size (in bytes) of each part of the fastq file processed by count_barcodes when using the mmap parser
+CHUNK_BYTES = 8 * 1024 * 1024
+
+# columns of the per-read debugging output
+DEBUG_COLUMNS = ['read_name', 'dropped', 'reversed', 'barcodes']
+
+# formats available for the per-read debugging output
+DEBUG_FORMATS = ['tsv', 'tsv.gz', 'parquet']
+
+# number of rows of debugging output that are buffered before being written
+DEBUG_BLOCK_SIZE = 100000
+
+# number of rows of counts that are written at once
+WRITE_CHUNK_SIZE = 100000
+
+# result for sets that were not searched because the quality of the read was too low
+LOW_QUALITY = 'low_quality'
+
+# offset of phred quality scores in fastq files
+PHRED_OFFSET = 33
+phred_tab = bytes([(i + PHRED_OFFSET) % 256 for i in range(256)])
+
+# results for variable sets that are not insertions - these are always counted exactly in top_k mode
+VARIABLE_CATEGORIES = ['none', 'no_insertion', 'ambiguous', LOW_QUALITY]
 
-# for reverse complmenting
-old_chars = "ACTGactg"
-new_chars = "TGACtgac"
-tab = str.maketrans("ACTGactg", "TGACtgac")
+# name used for the insertions that are not among the most frequent in top_k mode
+OTHER_INSERTIONS = 'other'
+
+# version of the search constructed by construct_search - increase this whenever the search dicts change, 
+# so that searches saved with --search-cache are constructed again
+SEARCH_VERSION = 6
+
+# engines available for matching constant barcodes with mismatches
+CONSTANT_ENGINES = ['auto', 'regex', 'neighbourhood', 'numpy']
+
+# maximum number of entries in a neighbourhood index when choosing an engine automatically
+MAX_NEIGHBOURHOOD_SIZE = 2000000
+
+# maximum number of sequences (including sequences with mismatches) in the automaton for a constant set that
+# is not at a fixed position in the read
+MAX_AUTOMATON_SIZE = 200000
+
+# letters used to construct neighbourhoods - any other character in a read is treated as 'N'
+NEIGHBOURHOOD_ALPHABET = "ACGTN"
+neighbourhood_tab = {i:'N' for i in range(256)}
+neighbourhood_tab.update(str.maketrans("ACGTacgt", "ACGTACGT"))
+
+# as for neighbourhood_tab, but keeping the case of each base, so that exact matches are case-sensitive 
+# (as they are for 'constant_exact' sets)
+EXACT_ALPHABET = "ACGTNacgt"
+exact_tab = {i:'N' for i in range(256)}
+exact_tab.update(str.maketrans("ACGTacgt", "ACGTacgt"))
+
+# maximum number of (read, barcode) distances computed at once by the numpy engine
+NUMPY_BATCH_CELLS = 2 ** 24
+
+# maximum number of translated insertions to remember
+TRANSLATION_CACHE_SIZE = 2 ** 16
 
 def main(argv):
 	#get arguments
 	parser = argparse.ArgumentParser(description='Count barcodes in NGS reads')
-	parser.add_argument('--fastq', '-f', help='Fastq file containing reads',  required=True)
+	parser.add_argument('--fastq', '-f', help="Fastq file containing reads ('-' to read from standard input)")
+	parser.add_argument('--fastq2', '-r', help="Fastq file containing the second read of each pair, for paired-end reads that have not been merged", default = None)
+	parser.add_argument('--collapsed-in', help='Table of distinct read sequences and their counts (from --collapsed-out) to use instead of a fastq file')
 	parser.add_argument('--barcodes', '-b', help='Barcodes yaml file specifying barcodes to find', required=True)
+	parser.add_argument('--search-cache', help="directory in which to save the search constructed for the barcodes yaml, so that it can be re-used by later runs with the same barcodes", default = None)
 	parser.add_argument('--fPrimer', '-p', help='Constant region of forward primer used for PCR (must be common to all reads)', type=str, required=True)
-	parser.add_argument('--out', '-o', help='Output file', default="counts.txt")
+	parser.add_argument('--out', '-o', help="Output file (gzipped if it ends in '.gz', or in parquet format if it ends in '.parquet')", default="counts.txt")
+	parser.add_argument('--marginals', help="directory in which to write a table of counts for each set of barcodes, regardless of the barcodes found in other sets", default = None)
 	parser.add_argument('--debug', help='Produce extra output useful for debugging', action='store_true')
 	parser.add_argument('--debug-output', help="output directory for debugging output", default = "out/")
+	parser.add_argument('--debug-sample', help="fraction of reads to write debugging output for (reads are chosen by name, so the same reads are chosen each time)", type=float, default = 1.0)
+	parser.add_argument('--debug-format', help="format of debugging output: 'tsv', 'tsv.gz' (gzipped) or 'parquet' (requires pyarrow)", choices = DEBUG_FORMATS, default = 'tsv')
+	parser.add_argument('--parser', help="fastq parser to use: 'raw' (fast, requires 4-line records), 'mmap' (requires 4-line records in an uncompressed file, each process reads its own part of the file) or 'seqio' (Biopython, slower but validates records)", choices = ['raw', 'mmap', 'seqio'], default = 'raw')
+	parser.add_argument('--decompressor', help="how to decompress gzipped input: 'pigz' (external process), 'isal' (python-isal module) or 'gzip' (the default, 'auto', uses the first of these that is available)", choices = DECOMPRESSORS, default = 'auto')
+	parser.add_argument('--threads', '--processes', '-t', help="number of processes to use for counting", type=int, default = 1)
+	parser.add_argument('--read-cache-size', help="number of distinct read sequences to remember results for (in each process), so that repeated reads are not checked again (0 to only re-use results within each chunk of reads)", type=int, default = 100000)
+	parser.add_argument('--collapse', help="count distinct read sequences first, then check each distinct sequence once", action='store_true')
+	parser.add_argument('--collapsed-out', help="save a table of distinct read sequences and their counts to this file (implies --collapse)", default = None)
+	parser.add_argument('--min-length', help="ignore reads shorter than this", type=int, default = None)
+	parser.add_argument('--max-length', help="ignore reads longer than this", type=int, default = None)
+	parser.add_argument('--primer-window', help="only search for the forward primer in this many bases at the start of the read (or the end of the read, for reads in the reverse orientation)", type=int, default = None)
+	parser.add_argument('--primer-start', help="expected (0-based) start of the forward primer in the read: if specified, the start of constant barcodes is adjusted for reads in which the primer is found elsewhere", type=int, default = None)
 	args = parser.parse_args()
 
 	# check arguments
+	if (args.fastq is None) == (args.collapsed_in is None):
+		raise ValueError("please specify either a fastq file (--fastq) or a table of collapsed reads (--collapsed-in)")
+	if args.parser == 'mmap' and args.fastq is not None and (args.fastq == '-' or guess_type(args.fastq)[1] is not None):
+		raise ValueError("the 'mmap' parser can only be used with uncompressed fastq files (not standard input)")
+	if args.collapsed_in is not None or args.collapsed_out is not None:
+		args.collapse = True
+	if args.fastq2 is not None and (args.collapse is True or args.parser == 'mmap'):
+		raise ValueError("paired-end reads (--fastq2) cannot be collapsed or read with the 'mmap' parser")
+	if args.collapse is True and args.debug is True:
+		raise ValueError("debugging output is not available when reads are collapsed")
+	if args.threads < 1:
+		raise ValueError("number of threads must be at least 1")
+	if args.read_cache_size < 0:
+		raise ValueError("read cache size must not be negative")
+	if args.min_length is not None and args.max_length is not None and args.min_length > args.max_length:
+		raise ValueError("minimum read length must not be greater than maximum read length")
+	if args.primer_window is not None and args.primer_window < len(args.fPrimer):
+		raise ValueError("primer window must be at least as long as the forward primer")
+	if args.primer_start is not None and args.primer_start < 0:
+		raise ValueError("primer start must not be negative")
+	if args.out.endswith('.parquet') and pa is None:
+		raise ValueError("pyarrow is required to write counts in parquet format")
+	if not 0 < args.debug_sample <= 1:
+		raise ValueError("debug sample must be greater than 0 and at most 1")
+	if args.debug is True and args.debug_format == 'parquet' and pa is None:
+		raise ValueError("pyarrow is required for debugging output in parquet format")
 	if args.debug is True:
 		path.isdir(args.debug_output)
 		# make csv
@@ -54,111 +190,1103 @@ def main(argv):
 	# parse barcodes yaml
 	barcs = parse_barcs_yaml(args)
 	
-	# construct search strategy
-	search = construct_search(barcs, args)
+	# construct search strategy (or load it, if it has already been constructed for these barcodes)
+	search = load_search(barcs, args)
+	if args.collapse is True and uses_quality(search):
+		raise ValueError("quality scores are not available when reads are collapsed, so 'min_quality' cannot be used")
+	
+	# keep track of the most frequent insertions for variable sets with 'top_k' specified
+	top_k = new_top_k(search)
 	
 	# count barcodes and write output
 	if args.debug is False:
-		counts = count_barcodes(args, search, False)	
+		counts = count_barcodes(args, search, False, top_k = top_k)	
 	else:
-		counts = count_barcodes(args, search, True, args.debug_output)
+		counts = count_barcodes(args, search, True, args.debug_output, top_k = top_k)
 		
 		
 		# write info
-	write_counts(args.out, counts, search)
+	marginals = write_counts(args.out, counts, search)
 	
 	print(f"saved counts in file {args.out}")
+	
+	if args.marginals is not None:
+		write_marginals(args.marginals, marginals, search, top_k)
+		print(f"saved counts for each set in directory {args.marginals}")
 
-def count_barcodes(args, search, debug=False, debug_read_folder = ""):
+def count_barcodes(args, search, debug=False, debug_read_folder = "", top_k = None):
 	"""
 	count barcodes that are specified barcs within reads in fastq file specified in args.fastq
+	
+	reads are processed in chunks - if args.threads is more than one, chunks are processed in 
+	parallel by a pool of worker processes and the results are combined in the same order as
+	the reads in the input file, so that the output is identical to a single-process run
+	
+	if 'top_k' (from new_top_k) is not empty, only the most frequent insertions in those variable sets
+	are kept as the results are combined, and the others are counted as OTHER_INSERTIONS
 	"""	
 	
+	tallies = new_tallies()
+	counts = Counter() # to store counts of combinations of barcodes
+	
+	if debug is True:
+		debug_info = path.realpath(f"{debug_read_folder}/debug_info.{args.debug_format}")
+		writer = DebugWriter(debug_info, args.debug_format)
+		
+	threads = args.threads
+	pool = None
+	primer = construct_primer_search(args)
+	read_filter = {'min_length':args.min_length, 'max_length':args.max_length}
+	
+	# either count reads as we go, or collapse identical reads first and then count distinct sequences
+	if args.collapse is True:
+		chunks = chunk_reads(collapse_reads(args).items(), CHUNK_SIZE)
+		worker = count_collapsed_chunk
+	elif args.parser == 'mmap':
+		# each chunk is a part of the file, which the worker reads itself
+		chunks = split_fastq(args.fastq, CHUNK_BYTES)
+		worker = count_fastq_part
+	else:
+		if args.fastq2 is not None:
+			reads = iter_paired_fastq(args.fastq, args.fastq2, args.parser, args.decompressor, uses_quality(search))
+		else:
+			reads = iter_fastq(args.fastq, args.parser, args.decompressor, uses_quality(search))
+		chunks = chunk_reads(reads, CHUNK_SIZE)
+		worker = count_chunk
+	
+	if threads > 1:
+		pool = multiprocessing.Pool(threads, initializer = init_worker, initargs = (primer, search, debug, args.read_cache_size, read_filter, args.debug_sample))
+		results = imap_bounded(pool, worker, chunks, 2 * threads)
+	else:
+		init_worker(primer, search, debug, args.read_cache_size, read_filter, args.debug_sample)
+		results = map(worker, chunks)
+	
+	# combine results from each chunk
+	prune_at = CHUNK_SIZE
+	for chunk_counts, chunk_tallies, rows in results:
+		counts.update(chunk_counts)
+		if top_k:
+			update_top_k(top_k, chunk_counts)
+			# fold infrequent insertions into OTHER_INSERTIONS every time the number of combinations doubles
+			if len(counts) > prune_at:
+				counts = fold_top_k(counts, top_k)
+				prune_at = 2 * len(counts) + CHUNK_SIZE
+		for key, value in chunk_tallies.items():
+			tallies[key] += value
+		if debug is True:
+			writer.write(rows)
+			
+	if pool is not None:
+		pool.close()
+		pool.join()
 	
-	checked_count = 0
-	dropped_count = 0
-	rev_count = 0
-	ambiguous_fPrimer = 0
-	counts = {} # to store counts of combinations of barcodes
+	if args.min_length is not None or args.max_length is not None:
+		limits = []
+		if args.min_length is not None:
+			limits.append(f"shorter than {args.min_length}")
+		if args.max_length is not None:
+			limits.append(f"longer than {args.max_length}")
+		print(f"filtered {tallies['length_filtered']} read(s) because they were {' or '.join(limits)} bases")
+	print(f"checked {tallies['checked']} reads in total; {tallies['reversed']} of these were correctly reversed")
+	print(f"dropped {tallies['dropped']} read(s) because forward primer could not be identified in forward or reverse orientation")	
+	print(f"forward primer appeared more than once in {tallies['ambiguous_fPrimer']} reads: if this number is high, consider re-running with a longer forward primer sequence")	
+	if uses_quality(search):
+		print(f"{tallies['low_quality']} read(s) had a mean quality below the minimum for one or more sets of barcodes")
+	if tallies['cache_hits'] > 0:
+		print(f"{tallies['cache_hits']} read(s) had the same sequence as a previously seen read, and were not checked again")
+	translations = tallies['translation_hits'] + tallies['translation_misses']
+	if translations > 0:
+		print(f"translated {translations} insertions, {tallies['translation_hits'] / translations:.1%} of which were already in the translation cache")
+		
+	if top_k:
+		counts = fold_top_k(counts, top_k)
+		for set_top_k in top_k:
+			print(f"kept the {len(set_top_k['counters'])} most frequent insertions in set {set_top_k['name']}, and counted the others as '{OTHER_INSERTIONS}': the count for each of these insertions is at most {set_top_k['max_error']} lower than the true count")
 	
 	if debug is True:
-		info = {}
-		debug_info = path.realpath(debug_read_folder + "/debug_info.tsv")
-		debug_info_handle = open(debug_info, "w", newline = "")
-		writer = csv.DictWriter(debug_info_handle, 
-								fieldnames = ['read_name', 'dropped', 'reversed', 'barcodes'],
-								delimiter = '\t')
-		writer.writeheader()
+		writer.close()
+		
+	return counts
+	
+def new_top_k(search):
+	"""
+	create a list with a dictionary for each variable set in which 'top_k' is specified, to keep track of 
+	the most frequent insertions in that set
+	
+	each dictionary contains the 'name' and 'index' of the set, the maximum number of insertions to keep ('k'),
+	the 'counters' for the insertions that are currently kept, and 'max_error', the most that any of these 
+	counters (and the count for any kept insertion) can be lower than the true count (see update_top_k)
+	"""
+	top_k = []
+	for i, set in enumerate(search):
+		if set['type'] == 'variable' and set.get('top_k') is not None:
+			top_k.append({'name':set['name'], 'index':i, 'k':set['top_k'], 'counters':{}, 'max_error':0})
+	return top_k
+	
+def update_top_k(top_k, counts):
+	"""
+	add the insertions in a Counter of combinations of barcodes to the counters in 'top_k' (from new_top_k)
+	
+	this is the Misra-Gries algorithm applied to a batch of counts: if there are more than k counters, the 
+	(k+1)th largest counter is subtracted from every counter, and counters that are no longer positive are 
+	removed.  So the count of an insertion is underestimated by at most the sum of the values subtracted 
+	('max_error'), which is at most the total count divided by k+1, and any insertion with a true count 
+	greater than 'max_error' is kept
+	"""
+	for set_top_k in top_k:
+		counters = set_top_k['counters']
+		index = set_top_k['index']
+		for combination, count in counts.items():
+			insertion = combination[index]
+			if insertion not in VARIABLE_CATEGORIES and insertion != OTHER_INSERTIONS:
+				counters[insertion] = counters.get(insertion, 0) + count
 		
+		if len(counters) > set_top_k['k']:
+			threshold = heapq.nlargest(set_top_k['k'] + 1, counters.values())[-1]
+			set_top_k['counters'] = {insertion:count - threshold for insertion, count in counters.items() if count > threshold}
+			set_top_k['max_error'] += threshold
+			
+def fold_top_k(counts, top_k):
+	"""
+	return a copy of the Counter 'counts', in which the insertions in each set in 'top_k' that are not currently
+	kept are replaced by OTHER_INSERTIONS, keeping the order in which combinations were first seen
+	
+	combinations are only folded while they are not kept, so the count for a kept insertion is never more
+	than its true count, and is at most 'max_error' lower
+	"""
+	folded = Counter()
+	for combination, count in counts.items():
+		combination = list(combination)
+		for set_top_k in top_k:
+			insertion = combination[set_top_k['index']]
+			if insertion not in VARIABLE_CATEGORIES and insertion not in set_top_k['counters']:
+				combination[set_top_k['index']] = OTHER_INSERTIONS
+		folded[tuple(combination)] += count
+	return folded
+	
+def new_tallies():
+	"""
+	create a dictionary to keep track of the number of reads that were filtered by length, checked, dropped, 
+	reversed, had an ambiguous forward primer and had low quality, as well as the use of the translation and read caches
+	"""
+	return {'length_filtered':0, 'checked':0, 'dropped':0, 'reversed':0, 'ambiguous_fPrimer':0, 'low_quality':0,
+			'translation_hits':0, 'translation_misses':0, 'cache_hits':0}
+	
+def collapse_reads(args):
+	"""
+	count the number of times each distinct sequence occurs in the reads in args.fastq, or read these 
+	counts from args.collapsed_in.  If args.collapsed_out is specified, save the counts to this file
+	
+	returns a Counter with the distinct sequences (in the order they first occur) and their counts
+	"""
+	if args.collapsed_in is not None:
+		collapsed = read_collapsed(args.collapsed_in)
+	else:
+		collapsed = Counter(seq for name, seq in iter_fastq(args.fastq, args.parser, args.decompressor))
 		
+	print(f"collapsed {sum(collapsed.values())} reads into {len(collapsed)} distinct sequences")
 	
-	# open fastq file and read every second line of four (lines with sequences)
-	# handle gzipped files as well as non-gzipped
-	# https://stackoverflow.com/questions/42757283/seqio-parse-on-a-fasta-gz
-	encoding = guess_type(args.fastq)[1]  # uses file extension
-	_open = partial(gzip.open, mode='rt') if encoding == 'gzip' else open
+	if args.collapsed_out is not None:
+		write_collapsed(args.collapsed_out, collapsed)
+		print(f"saved distinct sequences in file {args.collapsed_out}")
+		
+	return collapsed
+	
+def read_collapsed(filename):
+	"""
+	read a table of distinct sequences and their counts written by write_collapsed
+	"""
+	collapsed = Counter()
+	with open_fastq(filename) as handle:
+		reader = csv.reader(handle, delimiter = '\t')
+		header = next(reader)
+		if header != ['sequence', 'count']:
+			raise ValueError(f"{filename} does not look like a table of collapsed reads: expected columns 'sequence' and 'count'")
+		for seq, count in reader:
+			collapsed[seq] += int(count)
+	return collapsed
+	
+def write_collapsed(filename, collapsed):
+	"""
+	write a table of distinct sequences and their counts (gzipped if filename ends in .gz)
+	"""
+	encoding = guess_type(filename)[1]
+	_open = partial(gzip.open, mode = 'wt', newline = '') if encoding == 'gzip' else partial(open, mode = 'w', newline = '')
+	with _open(filename) as handle:
+		writer = csv.writer(handle, delimiter = '\t')
+		writer.writerow(['sequence', 'count'])
+		writer.writerows(collapsed.items())
+	
+def chunk_reads(reads, chunk_size):
+	"""
+	group an iterable of reads into lists containing chunk_size reads each
+	"""
+	reads = iter(reads)
+	while True:
+		chunk = list(islice(reads, chunk_size))
+		if len(chunk) == 0:
+			return
+		yield chunk
+		
+def imap_bounded(pool, func, iterable, max_pending):
+	"""
+	like pool.imap, but only consume items from iterable when there are fewer than max_pending
+	results outstanding, so that the whole input isn't read into memory if workers are slow
+	results are yielded in the same order as the items in iterable
+	"""
+	pending = deque()
+	for item in iterable:
+		pending.append(pool.apply_async(func, (item,)))
+		if len(pending) >= max_pending:
+			yield pending.popleft().get()
+	while len(pending) > 0:
+		yield pending.popleft().get()
+		
+def init_worker(primer, search, debug, cache_size = 0, read_filter = None, debug_sample = 1.0):
+	"""
+	store the information needed to count barcodes in this process, so that it 
+	doesn't need to be sent with every chunk of reads
+	"""
+	global worker_args
+	worker_args = {'primer':primer, 'search':search, 'debug':debug, 'cache_size':cache_size, 'debug_sample':debug_sample}
+	# cache of results for recently seen sequences, which is kept between chunks
+	worker_args['cache'] = OrderedDict() if cache_size > 0 else None
+	worker_args['read_filter'] = read_filter
+	
+def count_chunk(reads):
+	"""
+	count barcodes in a chunk of reads, using the arguments set by init_worker
+	"""
+	return count_reads(reads, worker_args['primer'], worker_args['search'], worker_args['debug'], 
+						worker_args['cache'], worker_args['cache_size'], worker_args['read_filter'], worker_args['debug_sample'])
 
-	with _open(args.fastq) as handle:
-		for record in SeqIO.parse(handle, "fastq"):
-			if debug is True:
-				info['read_name'] = record.id
-		
-			# check for forward primer in read:
-			reversed = False
-			
-			# check for forward primer in read - if not found, take reverse complement
-			n_matches = record.seq.lower().count(args.fPrimer.lower())
-			if n_matches == 0:
-				# check reverse complement
-				record.seq = record.seq.reverse_complement()
-				n_matches = record.seq.lower().count(args.fPrimer.lower())
-				reversed = True
-				# if we still can't find it, drop this read
-				if n_matches == 0:
-					dropped_count += 1
-					if debug is True:
-						info['dropped'] = True
-						info['reversed'] = 'NA'
-						info['barcodes'] = 'NA'
-					continue
-					
-			# check for multiple matches
-			if n_matches > 1:
-					ambiguous_fPrimer += 1
-					dropped_count += 1
-					continue
-					
-			if reversed is True:
-				rev_count += 1
-				if debug is True:
-					info['reversed'] = True
-					info['dropped'] = False
-			else:
-				if debug is True:
-					info['reversed'] = False
-					info['dropped'] = False
-					
-			# check for barcodes
-			found_barcs = find_barcodes_in_line(str(record.seq), search)
+def count_fastq_part(part):
+	"""
+	count barcodes in the reads in part of a fastq file, a tuple of the file name and the start and end of 
+	the part (from split_fastq), using the arguments set by init_worker
+	"""
+	filename, start, end = part
+	with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+		reads = list(read_fastq_mmap(buffer, start, end, uses_quality(worker_args['search'])))
+	return count_chunk(reads)
+	
+def count_collapsed_chunk(collapsed):
+	"""
+	count barcodes in a chunk of distinct sequences and their counts, using the arguments set by init_worker
+	"""
+	return count_collapsed(collapsed, worker_args['primer'], worker_args['search'], worker_args['read_filter'])
+	
+def construct_primer_search(args):
+	"""
+	Construct a dictionary that specifies how to search for the forward primer
+	
+	This contains the (lowercase) primer sequence 'seq' and its reverse complement 'rc', the number of bases at the 
+	start (or end) of the read to search for the primer ('window', None to search the whole read), the expected 
+	'start' of the primer in the read (None if constant barcodes should not be re-anchored on the primer), and 
+	whether reads are pairs of mates that have not been merged ('paired', see orient_pair)
+	"""
+	primer = {'seq':args.fPrimer.lower()}
+	# the primer occurs in the reverse complement of a read as many times as 
+	# the reverse complement of the primer occurs in the read
+	primer['rc'] = primer['seq'].translate(tab)[::-1]
+	primer['window'] = args.primer_window
+	primer['start'] = args.primer_start
+	primer['paired'] = args.fastq2 is not None
+	
+	return primer
+	
+def orient_read(seq, primer):
+	"""
+	look for the forward primer specified by the dictionary 'primer' (from construct_primer_search) in 'seq'
+	
+	returns the number of times the primer was found, whether or not it was found in the reverse orientation, 
+	and the offset of the primer from primer['start'] in the correctly oriented read (0 if primer['start'] is None)
+	
+	if primer['paired'] is True, 'seq' is a pair of mates (see orient_pair)
+	"""
+	if primer['paired'] is True:
+		return orient_pair(seq, primer)
+		
+	lowered = seq.lower()
+	window = len(lowered) if primer['window'] is None else primer['window']
+	
+	# check for forward primer in read
+	n_matches = lowered.count(primer['seq'], 0, window)
+	if n_matches > 0:
+		if primer['start'] is None:
+			return n_matches, False, 0
+		return n_matches, False, lowered.find(primer['seq'], 0, window) - primer['start']
+	
+	# if not found, check for its reverse complement at the end of the read
+	window_start = max(0, len(lowered) - window)
+	n_matches = lowered.count(primer['rc'], window_start)
+	if n_matches == 0 or primer['start'] is None:
+		return n_matches, True, 0
+	position = len(lowered) - lowered.find(primer['rc'], window_start) - len(primer['rc'])
+	return n_matches, True, position - primer['start']
 
-			checked_count += 1
-			if debug is True:
-				info['barcodes'] = "__".join(found_barcs)
+def orient_pair(pair, primer):
+	"""
+	look for the forward primer specified by the dictionary 'primer' at the start of each mate in a (seq1, seq2) 
+	pair of reads - if it is not found in the first mate, the pair is in the reverse orientation and the primer 
+	should be found in the second mate
+	
+	returns the number of times the primer was found, whether or not the pair is in the reverse orientation
+	(in which case the mates should be swapped), and the offset of the primer from primer['start'] in the mate 
+	in which it was found (0 if primer['start'] is None)
+	"""
+	for reversed, seq in zip((False, True), pair):
+		lowered = seq.lower()
+		window = len(lowered) if primer['window'] is None else primer['window']
+		n_matches = lowered.count(primer['seq'], 0, window)
+		if n_matches > 0:
+			if primer['start'] is None:
+				return n_matches, reversed, 0
+			return n_matches, reversed, lowered.find(primer['seq'], 0, window) - primer['start']
+	return 0, True, 0
+	
+def count_reads(reads, primer, search, debug=False, cache=None, cache_size=0, read_filter=None, debug_sample=1.0):
+	"""
+	count barcodes in an iterable of (name, seq) tuples, or (name, seq, qual) tuples if any of the sets
+	in 'search' has a minimum quality (see check_read_quality).  For paired reads (see orient_pair), 
+	'seq' and 'qual' are tuples with one sequence or quality string for each mate
+	
+	reads with lengths outside the limits in 'read_filter' (see check_length) are ignored
+	
+	reads with identical sequences (and, if quality is checked, the same sets with low quality) are only 
+	classified once.  If 'cache' is an OrderedDict, results for the most recent 'cache_size' distinct 
+	sequences are kept in it, so that they can be re-used for later chunks
+	
+	returns a Counter of the number of reads with each combination of barcodes, a dictionary
+	of the number of reads that were checked, dropped, reversed and had an ambiguous forward primer,
+	and the debugging output (if debug is True) for a fraction 'debug_sample' of the reads, as a 
+	dictionary of lists with one list for each column in DEBUG_COLUMNS
+	"""
+	tallies = new_tallies()
+	counts = Counter()
+	rows = new_debug_rows()
+	cache_info = translate_insertion.cache_info()
+	
+	# get results for sequences that we've already seen
+	# ignore reads with lengths outside the limits, but keep track of where they were for the debugging output
+	all_reads = list(reads)
+	if read_filter is None:
+		reads = all_reads
+		kept = [True] * len(all_reads)
+	else:
+		kept = [check_length(read[1], read_filter) for read in all_reads]
+		reads = [read for read, read_kept in zip(all_reads, kept) if read_kept]
+		tallies['length_filtered'] += len(all_reads) - len(reads)
+		
+	# if quality is checked, reads are classified by their sequence and the sets that are rejected for low quality
+	orientations = None
+	if uses_quality(search):
+		rejected, weights, orientations = check_read_quality(reads, primer, search)
+		tallies['low_quality'] += sum([1 for read_rejected, weight in zip(rejected, weights) if len(read_rejected) > 0 or weight != 1])
+		keys = [(read[1], read_rejected) for read, read_rejected in zip(reads, rejected)]
+	else:
+		weights = [1] * len(reads)
+		keys = [read[1] for read in reads]
+		
+	results = {}
+	for key in keys:
+		if key in results:
+			tallies['cache_hits'] += 1
+		elif cache is not None and key in cache:
+			tallies['cache_hits'] += 1
+			cache.move_to_end(key)
+			results[key] = cache[key]
+		else:
+			results[key] = None
 			
-			# increment count for this combination
-			if debug is True:
-				writer.writerow(info)
+	# classify sequences we haven't seen before
+	new_keys = [key for key, result in results.items() if result is None]
+	if uses_quality(search):
+		new_results = classify_reads([key[0] for key in new_keys], primer, search, [key[1] for key in new_keys], orientations)
+	else:
+		new_results = classify_reads(new_keys, primer, search)
+	results.update(new_results)
+	if cache is not None:
+		cache.update(new_results)
+		while len(cache) > cache_size:
+			cache.popitem(last = False)
+		
+	# tally reads (and write debugging output) in the order they were read
+	classified = zip(keys, weights)
+	for read, read_kept in zip(all_reads, kept):
+		name = read[0]
+		if read_kept is False:
+			if debug is True and sample_read(name, debug_sample):
+				add_debug_row(rows, name, True, 'NA', 'NA')
+			continue
+		key, weight = next(classified)
+		n_matches, reversed, found_barcs = results[key]
+		tally_read(tallies, counts, n_matches, reversed, found_barcs, quality_weight = weight)
+		if debug is True and sample_read(name, debug_sample):
+			if found_barcs is None:
+				add_debug_row(rows, name, True, 'NA', 'NA')
+			else:
+				add_debug_row(rows, name, False, reversed, "__".join(found_barcs))
+		
+	# keep track of how often insertions were already in the translation cache
+	tallies['translation_hits'] = translate_insertion.cache_info().hits - cache_info.hits
+	tallies['translation_misses'] = translate_insertion.cache_info().misses - cache_info.misses
+		
+	return counts, tallies, rows
+	
+def count_collapsed(collapsed, primer, search, read_filter=None):
+	"""
+	count barcodes in an iterable of distinct sequences and the number of times they occur, (seq, count) tuples
+	
+	returns a Counter of the number of reads with each combination of barcodes, a dictionary of tallies (as for
+	count_reads) and empty debugging output (debugging output is not available for collapsed reads)
+	"""
+	tallies = new_tallies()
+	counts = Counter()
+	cache_info = translate_insertion.cache_info()
+	
+	collapsed = list(collapsed)
+	if read_filter is not None:
+		tallies['length_filtered'] += sum([count for seq, count in collapsed if not check_length(seq, read_filter)])
+		collapsed = [(seq, count) for seq, count in collapsed if check_length(seq, read_filter)]
+		
+	results = classify_reads([seq for seq, count in collapsed], primer, search)
+	for seq, count in collapsed:
+		tally_read(tallies, counts, *results[seq], weight = count)
+		
+	# keep track of how often insertions were already in the translation cache
+	tallies['translation_hits'] = translate_insertion.cache_info().hits - cache_info.hits
+	tallies['translation_misses'] = translate_insertion.cache_info().misses - cache_info.misses
+	
+	return counts, tallies, new_debug_rows()
+	
+def check_length(seq, read_filter):
+	"""
+	check that the length of a read is within the limits 'min_length' and 'max_length' in read_filter 
+	(either of which may be None, for no limit).  For paired reads, the length of each mate is checked
+	"""
+	if isinstance(seq, tuple):
+		return all([check_length(mate, read_filter) for mate in seq])
+	if read_filter['min_length'] is not None and len(seq) < read_filter['min_length']:
+		return False
+	if read_filter['max_length'] is not None and len(seq) > read_filter['max_length']:
+		return False
+	return True
+	
+def classify_reads(seqs, primer, search, rejected = None, orientations = None):
+	"""
+	check the orientation of, and look for barcodes in, each of the sequences in 'seqs'
+	
+	returns a dictionary with each sequence as a key, and a tuple of the number of times the forward primer was 
+	found, whether it was found in the reverse orientation, and a tuple of the barcodes found as the value 
+	(barcodes are only searched for in reads in which the primer was found exactly once, otherwise this is None)
+	
+	if 'rejected' is specified, it contains a tuple for each sequence of the names of the sets that are not 
+	searched because of low quality (see check_read_quality), and the keys are (sequence, rejected) tuples
+	
+	'orientations' is a dictionary of the result of orient_read for sequences that have already been oriented
+	(see check_read_quality), which are not oriented again
+	"""
+	if orientations is None:
+		orientations = {}
+	results = {}
+	oriented = [] # reads in which we found the forward primer once, in the correct orientation
+	keys = seqs if rejected is None else list(zip(seqs, rejected))
+	
+	for seq, key in zip(seqs, keys):
+		# check for forward primer in read - if not found, check for its reverse complement
+		n_matches, reversed, offset = orientations[seq] if seq in orientations else orient_read(seq, primer)
+		
+		# if we can't find it, or we find it more than once, drop this read
+		if n_matches != 1:
+			results[key] = (n_matches, reversed, None)
+			continue
+				
+		# only reverse complement reads we're going to keep (or, for pairs, swap the mates)
+		if reversed is True and primer['paired'] is True:
+			oriented.append((key, seq[::-1], reversed, offset))
+		elif reversed is True:
+			oriented.append((key, seq.translate(tab)[::-1], reversed, offset))
+		else:
+			oriented.append((key, seq, reversed, offset))
 				
-			counts = increment_counter(counts, found_barcs)
+	# check for barcodes
+	oriented_rejected = None if rejected is None else [read[0][1] for read in oriented]
+	if primer['paired'] is True:
+		found = find_barcodes_in_pairs([read[1] for read in oriented], search, [read[3] for read in oriented], oriented_rejected)
+	else:
+		found = find_barcodes_in_lines([read[1] for read in oriented], search, [read[3] for read in oriented], oriented_rejected)
 	
-	print(f"checked {checked_count} reads in total; {rev_count} of these were correctly reversed")
-	print(f"dropped {dropped_count} read(s) because forward primer could not be identified in forward or reverse orientation")	
-	print(f"forward primer appeared more than once in {ambiguous_fPrimer} reads: if this number is high, consider re-running with a longer forward primer sequence")	
+	for (key, oriented_seq, reversed, offset), found_barcs in zip(oriented, found):
+		results[key] = (1, reversed, tuple(found_barcs))
+		
+	return results
 	
-	if debug is True:
-		debug_info_handle.close()
+def uses_quality(search):
+	"""
+	check if any of the sets in 'search' has a minimum quality, in which case reads must include quality scores
+	"""
+	return any([set.get('min_quality') is not None for set in search])
+	
+def check_read_quality(reads, primer, search):
+	"""
+	check the quality of the windows for each set with a 'min_quality' in each of the (name, seq, qual) tuples 
+	in 'reads', in the correct orientation (see check_quality).  Reads in which the forward primer is not found 
+	exactly once are not checked
+	
+	returns a list with a tuple for each read of the names of the sets which should not be searched, a list 
+	of the weight of each read, which is the product of the 'quality_weight' of the other low-quality sets,
+	and a dictionary of the result of orient_read for each distinct sequence (so that reads are only oriented once)
+	"""
+	orientations = {}
+	oriented = [] # index, oriented quality string and offset of reads in which we found the forward primer once
+	for i, (name, seq, qual) in enumerate(reads):
+		if seq not in orientations:
+			orientations[seq] = orient_read(seq, primer)
+		n_matches, reversed, offset = orientations[seq]
+		if n_matches == 1:
+			oriented.append((i, qual[::-1] if reversed is True else qual, offset))
+			
+	rejected = [()] * len(reads)
+	weights = [1] * len(reads)
+	if primer['paired'] is True:
+		# check the sets on each mate and strand separately, with the offset only applying to the first mate
+		low = [()] * len(oriented)
+		for (mate, strand), indices in group_sets_by_view(search).items():
+			quals = [pair_view(read[1], mate, strand, complement = False) for read in oriented]
+			offsets = [read[2] if (mate, strand) == (1, 'forward') else 0 for read in oriented]
+			view_low = check_quality(quals, [search[j] for j in indices], offsets)
+			low = [read_low + read_view_low for read_low, read_view_low in zip(low, view_low)]
+	else:
+		low = check_quality([read[1] for read in oriented], search, [read[2] for read in oriented])
+	sets = {set['name']:set for set in search}
+	for (i, qual, offset), low_sets in zip(oriented, low):
+		if len(low_sets) == 0:
+			continue
+		rejected[i] = tuple([name for name in low_sets if sets[name]['quality_weight'] is None])
+		for name in low_sets:
+			if sets[name]['quality_weight'] is not None:
+				weights[i] *= sets[name]['quality_weight']
+	return rejected, weights, orientations
+	
+def check_quality(quals, search, offsets):
+	"""
+	find the sets with a 'min_quality' for which the mean phred score in the 'quality_window' is below the 
+	minimum in each of the quality strings in 'quals'.  The windows for constant sets are shifted by the 
+	corresponding element of 'offsets', like the barcodes themselves (see get_subread)
+	
+	windows that are empty (for example, because the read is too short) are not below the minimum
+	
+	if numpy is available, all the quality strings are decoded at once, and the sum of scores in each
+	window is found from their cumulative sum
+	
+	returns a list with a tuple of the names of the low-quality sets for each quality string
+	"""
+	checked = [set for set in search if set.get('min_quality') is not None]
+	if len(quals) == 0 or len(checked) == 0:
+		return [()] * len(quals)
 		
-	return counts
+	if np is None:
+		low = []
+		for qual, offset in zip(quals, offsets):
+			encoded = qual.encode()
+			low_sets = []
+			for set in checked:
+				start, stop = quality_window(set, offset, len(encoded))
+				if stop > start and sum(encoded[start:stop]) - PHRED_OFFSET * (stop - start) < set['min_quality'] * (stop - start):
+					low_sets.append(set['name'])
+			low.append(tuple(low_sets))
+		return low
+		
+	scores = np.frombuffer("".join(quals).encode(), dtype = np.uint8).astype(np.int64) - PHRED_OFFSET
+	cumulative = np.concatenate(([0], np.cumsum(scores)))
+	lengths = np.array([len(qual) for qual in quals], dtype = np.int64)
+	read_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+	offsets = np.array(offsets, dtype = np.int64)
+	
+	is_low = np.zeros((len(quals), len(checked)), dtype = bool)
+	for j, set in enumerate(checked):
+		start, stop = quality_window(set, offsets, lengths)
+		stop = np.maximum(stop, start)
+		sums = cumulative[read_starts + stop] - cumulative[read_starts + start]
+		is_low[:, j] = (stop > start) & (sums < set['min_quality'] * (stop - start))
+		
+	names = [set['name'] for set in checked]
+	return [tuple([names[j] for j in np.flatnonzero(row).tolist()]) for row in is_low]
+	
+def quality_window(set, offset, length):
+	"""
+	get the start and stop of the 'quality_window' for a set in a read of length 'length', shifted by 'offset' 
+	for constant sets.  Works on integers, or numpy arrays of offsets and lengths
+	
+	as in get_subread, a window that would start before the beginning of the read is empty (windows for sets 
+	of type 'constant_automaton', or variable sets, are not shifted)
+	"""
+	start, stop = set['quality_window']
+	if set['type'] == 'variable' or set['start'] is None:
+		offset = 0
+	start = start + offset
+	stop = length if stop is None else stop + offset
+	if np is not None and isinstance(length, np.ndarray):
+		empty = start < 0
+		start = np.clip(start, 0, length)
+		stop = np.where(empty, start, np.clip(stop, 0, length))
+		return start, stop
+	if start < 0:
+		return 0, 0
+	return min(start, length), max(0, min(stop, length))
+	
+def tally_read(tallies, counts, n_matches, reversed, found_barcs, weight = 1, quality_weight = 1):
+	"""
+	add 'weight' reads with the result from classify_reads to the tallies and counts
+	
+	the count for the combination of barcodes found is also multiplied by 'quality_weight' (see check_read_quality)
+	"""
+	# if we couldn't find the primer, drop this read
+	if n_matches == 0:
+		tallies['dropped'] += weight
+		return
+			
+	# check for multiple matches
+	if n_matches > 1:
+		tallies['ambiguous_fPrimer'] += weight
+		tallies['dropped'] += weight
+		return
+			
+	if reversed is True:
+		tallies['reversed'] += weight
+		
+	tallies['checked'] += weight
+		
+	# increment count for this combination
+	increment_counter(counts, found_barcs, weight * quality_weight)
+	
+def new_debug_rows():
+	"""
+	create empty columns for the per-read debugging output
+	"""
+	return {column:[] for column in DEBUG_COLUMNS}
+	
+def add_debug_row(rows, name, dropped, reversed, barcodes):
+	"""
+	add a row for one read to the columns of debugging output
+	"""
+	rows['read_name'].append(name)
+	rows['dropped'].append(dropped)
+	rows['reversed'].append(reversed)
+	rows['barcodes'].append(barcodes)
+	
+def sample_read(name, rate):
+	"""
+	decide whether to write debugging output for a read, so that a fraction 'rate' of reads are chosen
+	
+	reads are chosen using a hash of their name, so the same reads are chosen regardless of how the 
+	reads are split into chunks and processes
+	"""
+	if rate >= 1:
+		return True
+	return zlib.crc32(name.encode()) < rate * 2 ** 32
+	
+class DebugWriter:
+	"""
+	write per-read debugging output, in which each row is buffered in columns and written in blocks
+	of DEBUG_BLOCK_SIZE rows
+	
+	the output format is one of DEBUG_FORMATS: a (optionally gzipped) tab-separated file, or a 
+	parquet file, in which 'reversed' and 'barcodes' are missing (rather than 'NA') for dropped reads
+	"""
+	def __init__(self, filename, format = 'tsv', block_size = DEBUG_BLOCK_SIZE):
+		self.format = format
+		self.block_size = block_size
+		self.rows = new_debug_rows()
+		self.n_rows = 0
+		if format == 'parquet':
+			self.schema = pa.schema([('read_name', pa.string()), ('dropped', pa.bool_()), 
+									('reversed', pa.bool_()), ('barcodes', pa.string())])
+			self.writer = pq.ParquetWriter(filename, self.schema)
+		else:
+			if format == 'tsv.gz':
+				self.handle = gzip.open(filename, 'wt', newline = "")
+			else:
+				self.handle = open(filename, 'w', newline = "")
+			self.writer = csv.writer(self.handle, delimiter = '\t')
+			self.writer.writerow(DEBUG_COLUMNS)
+			
+	def write(self, rows):
+		"""
+		add columns of rows (from new_debug_rows) to the buffer, and write them if the buffer is full
+		"""
+		for column in DEBUG_COLUMNS:
+			self.rows[column].extend(rows[column])
+		self.n_rows += len(rows['read_name'])
+		if self.n_rows >= self.block_size:
+			self.flush()
+			
+	def flush(self):
+		"""
+		write the buffered rows
+		"""
+		if self.n_rows == 0:
+			return
+		if self.format == 'parquet':
+			columns = dict(self.rows)
+			columns['reversed'] = [None if value == 'NA' else value for value in columns['reversed']]
+			columns['barcodes'] = [None if value == 'NA' else value for value in columns['barcodes']]
+			self.writer.write_table(pa.table(columns, schema = self.schema))
+		else:
+			self.writer.writerows(zip(*[self.rows[column] for column in DEBUG_COLUMNS]))
+		self.rows = new_debug_rows()
+		self.n_rows = 0
+		
+	def close(self):
+		"""
+		write any remaining rows and close the file
+		"""
+		self.flush()
+		if self.format == 'parquet':
+			self.writer.close()
+		else:
+			self.handle.close()
+	
+def open_fastq(filename, decompressor = 'auto'):
+	"""
+	open a fastq file for reading in text mode, with a large read buffer
+	handle gzipped files as well as non-gzipped
+	https://stackoverflow.com/questions/42757283/seqio-parse-on-a-fasta-gz
+	
+	gzipped files are decompressed in a background thread (or a separate pigz process) - see open_gzip
+	
+	if filename is '-', read from standard input, which may also be gzipped
+	"""
+	if filename == '-':
+		return open_stdin(decompressor)
+		
+	encoding = guess_type(filename)[1]  # uses file extension
+	if encoding == 'gzip':
+		return io.TextIOWrapper(io.BufferedReader(open_gzip(filename, decompressor), buffer_size = BUFFER_SIZE))
+	return open(filename, 'r', buffering = BUFFER_SIZE)
+	
+def open_stdin(decompressor = 'auto'):
+	"""
+	open standard input for reading in text mode, checking if it is gzipped from the first two bytes
+	
+	if it's gzipped, it is decompressed in a background thread using python-isal (if available, or if 
+	specified by 'decompressor') or the gzip module.  pigz can't be used, because we've already read from the input
+	"""
+	stdin = io.BufferedReader(sys.stdin.buffer.raw, buffer_size = BUFFER_SIZE)
+	if stdin.peek(2)[:2] != b'\x1f\x8b':
+		return io.TextIOWrapper(stdin)
+		
+	if decompressor == 'pigz':
+		raise ValueError("pigz can't be used to decompress standard input: please use a different decompressor")
+	elif decompressor == 'isal' or (decompressor == 'auto' and igzip is not None):
+		if igzip is None:
+			raise ValueError("couldn't import isal: please install it or use a different decompressor")
+		handle = igzip.IGzipFile(fileobj = stdin, mode = 'rb')
+	else:
+		handle = gzip.GzipFile(fileobj = stdin, mode = 'rb')
+	return io.TextIOWrapper(io.BufferedReader(QueueReader(handle), buffer_size = BUFFER_SIZE))
+	
+def open_gzip(filename, decompressor = 'auto'):
+	"""
+	open a gzipped file for reading in binary mode, decompressing it in the background
+	
+	the file is decompressed using pigz (in a separate process) or python-isal if they are available (or if 
+	specified by 'decompressor'), otherwise with the gzip module.  Decompressed data is read in a background thread
+	"""
+	if decompressor == 'auto':
+		if shutil.which('pigz') is not None:
+			decompressor = 'pigz'
+		elif igzip is not None:
+			decompressor = 'isal'
+		else:
+			decompressor = 'gzip'
+			
+	if decompressor == 'pigz':
+		if shutil.which('pigz') is None:
+			raise ValueError("couldn't find pigz: please install it or use a different decompressor")
+		process = subprocess.Popen(['pigz', '-dc', filename], stdout = subprocess.PIPE)
+		return QueueReader(process.stdout, process)
+	elif decompressor == 'isal':
+		if igzip is None:
+			raise ValueError("couldn't import isal: please install it or use a different decompressor")
+		return QueueReader(igzip.open(filename, 'rb'))
+	else:
+		return QueueReader(gzip.open(filename, 'rb'))
+	
+class QueueReader(io.RawIOBase):
+	"""
+	Read-only binary file that reads blocks of data from 'handle' in a background thread, and passes them 
+	through a bounded queue, so that reading (and decompressing) the data happens at the same time as parsing it
+	
+	if 'process' is specified, 'handle' is its output - an error is raised if it doesn't exit successfully
+	"""
+	def __init__(self, handle, process = None, block_size = BUFFER_SIZE, queue_size = DECOMPRESS_QUEUE_SIZE):
+		self.handle = handle
+		self.process = process
+		self.block_size = block_size
+		self.queue = queue.Queue(queue_size)
+		self.block = memoryview(b"")
+		self.finished = False
+		self.stopping = False
+		self.error = None
+		self.thread = threading.Thread(target = self._fill, daemon = True)
+		self.thread.start()
+		
+	def _fill(self):
+		"""
+		read blocks from the handle and put them in the queue - an empty block signals the end of the data
+		"""
+		try:
+			while not self.stopping:
+				block = self.handle.read(self.block_size)
+				if not block:
+					break
+				self.queue.put(block)
+			if self.process is not None and not self.stopping:
+				if self.process.wait() != 0:
+					raise OSError(f"decompression process {' '.join(self.process.args)} exited with code {self.process.returncode}")
+		except Exception as e:
+			self.error = e
+		self.queue.put(b"")
+		
+	def readable(self):
+		return True
+		
+	def readinto(self, buffer):
+		# get the next block of data if we've used all of the current one
+		while len(self.block) == 0:
+			if self.finished:
+				return 0
+			self.block = memoryview(self.queue.get())
+			if len(self.block) == 0:
+				self.finished = True
+				if self.error is not None:
+					raise self.error
+				
+		n = min(len(buffer), len(self.block))
+		buffer[:n] = self.block[:n]
+		self.block = self.block[n:]
+		return n
+		
+	def close(self):
+		if not self.closed:
+			# stop the background thread, emptying the queue in case it's waiting to add a block
+			self.stopping = True
+			while self.thread.is_alive():
+				try:
+					self.queue.get(timeout = 0.1)
+				except queue.Empty:
+					pass
+			if self.process is not None:
+				self.process.stdout.close()
+				self.process.wait()
+			else:
+				self.handle.close()
+		super().close()
+	
+def iter_fastq(filename, parser = 'raw', decompressor = 'auto', quality = False):
+	"""
+	iterate over (name, sequence) tuples for the reads in the fastq file 'filename', 
+	or (name, sequence, quality) tuples if 'quality' is True
+	"""
+	if parser == 'mmap':
+		if path.getsize(filename) == 0:
+			return
+		with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+			yield from read_fastq_mmap(buffer, quality = quality)
+		return
+		
+	with open_fastq(filename, decompressor) as handle:
+		yield from read_fastq(handle, parser, quality)
+	
+def iter_paired_fastq(filename1, filename2, parser = 'raw', decompressor = 'auto', quality = False):
+	"""
+	iterate over the pairs of reads in the fastq files 'filename1' and 'filename2', which must contain the mates 
+	of each pair in the same order.  Yields (name, (seq1, seq2)) tuples, or (name, (seq1, seq2), (qual1, qual2)) 
+	tuples if 'quality' is True, where the name is the name of the first mate
+	"""
+	reads1 = iter_fastq(filename1, parser, decompressor, quality)
+	reads2 = iter_fastq(filename2, parser, decompressor, quality)
+	for read1, read2 in zip_longest(reads1, reads2):
+		if read1 is None or read2 is None:
+			raise ValueError(f"{filename1} and {filename2} contain different numbers of reads")
+		if mate_name(read1[0]) != mate_name(read2[0]):
+			raise ValueError(f"mates of read {read1[0]} are not in the same order in {filename1} and {filename2} (found {read2[0]})")
+		if quality is True:
+			yield read1[0], (read1[1], read2[1]), (read1[2], read2[2])
+		else:
+			yield read1[0], (read1[1], read2[1])
+			
+def mate_name(name):
+	"""
+	get the name of a read without the suffix '/1' or '/2' that may be used to identify mates
+	"""
+	if name[-2:] in ('/1', '/2'):
+		return name[:-2]
+	return name
+	
+def split_fastq(filename, chunk_bytes):
+	"""
+	split an uncompressed fastq file into parts of approximately chunk_bytes bytes, each of which starts at the 
+	beginning of a record.  Yields a tuple of the file name and the start and end of each part
+	"""
+	if path.getsize(filename) == 0:
+		return
+		
+	with open(filename, 'rb') as handle, mmap.mmap(handle.fileno(), 0, access = mmap.ACCESS_READ) as buffer:
+		start = 0
+		while start < len(buffer):
+			end = find_record_start(buffer, start + chunk_bytes)
+			yield filename, start, end
+			start = end
+			
+def find_record_start(buffer, position):
+	"""
+	find the start of the first fastq record in 'buffer' that starts at or after 'position'
+	
+	quality lines may also start with '@', but only a header is followed two lines later by a line starting with '+'
+	"""
+	if position >= len(buffer):
+		return len(buffer)
+		
+	# go to the start of the next line
+	if position == 0:
+		line_start = 0
+	else:
+		line_start = buffer.find(b'\n', position - 1) + 1
+		if line_start == 0:
+			return len(buffer)
+			
+	while line_start < len(buffer):
+		seq_start = buffer.find(b'\n', line_start) + 1
+		if seq_start == 0:
+			break
+		plus_start = buffer.find(b'\n', seq_start) + 1
+		if plus_start == 0 or plus_start >= len(buffer):
+			break
+		if buffer[line_start] == ord('@') and buffer[plus_start] == ord('+'):
+			return line_start
+		line_start = seq_start
+	return len(buffer)
+	
+def read_fastq_mmap(buffer, start = 0, end = None, quality = False):
+	"""
+	iterate over reads in part of a memory-mapped fastq file, yielding a (name, sequence) tuple for each read,
+	or a (name, sequence, quality) tuple if 'quality' is True
+	
+	records are assumed to span exactly four lines.  Record boundaries are found in the buffer, and only the header
+	and sequence are copied out of it (unless 'quality' is True, quality lines are only checked to be the same length 
+	as the sequence, without being read into python objects)
+	"""
+	end = len(buffer) if end is None else end
+	find = buffer.find
+	position = start
+	while position < end:
+		seq_start = find(b'\n', position, end) + 1
+		plus_start = find(b'\n', seq_start, end) + 1 if seq_start > 0 else 0
+		qual_start = find(b'\n', plus_start, end) + 1 if plus_start > 0 else 0
+		
+		# ignore blank lines at the end of the file - otherwise, if there's nothing left for the quality line,
+		# the record is incomplete
+		complete = qual_start != 0 and qual_start < end
+		if not complete and buffer[position:end].strip() == b"":
+			return
+		if not complete or buffer[position] != ord('@') or buffer[plus_start] != ord('+'):
+			raise ValueError(f"fastq record starting at byte {position} is not a valid 4-line record: try running with '--parser seqio'")
+			
+		name = buffer[position + 1:seq_start - 1].split(None, 1)[0].decode()
+		seq = buffer[seq_start:plus_start - 1].rstrip().decode()
+		
+		# skip quality line (without copying it, unless it has trailing whitespace), but check that it's the 
+		# same length as the sequence
+		qual_end = find(b'\n', qual_start, end)
+		qual_end = end if qual_end == -1 else qual_end
+		if qual_end - qual_start != len(seq) and len(buffer[qual_start:qual_end].rstrip()) != len(seq):
+			raise ValueError(f"fastq record starting at byte {position} has a quality line of a different length to its sequence: try running with '--parser seqio'")
+		if quality is True:
+			yield name, seq, buffer[qual_start:qual_end].rstrip().decode()
+		else:
+			yield name, seq
+		position = qual_end + 1
+	
+def read_fastq(handle, parser = 'raw', quality = False):
+	"""
+	iterate over reads in an open fastq file, yielding a (name, sequence) tuple for each read,
+	or a (name, sequence, quality) tuple if 'quality' is True
+	
+	if parser is 'raw', records are assumed to span exactly four lines, and are read without
+	constructing any Biopython objects.  If parser is 'seqio', records are parsed using 
+	Bio.SeqIO, which is slower but checks that each record is valid
+	"""
+	if parser == 'seqio':
+		for record in SeqIO.parse(handle, "fastq"):
+			if quality is True:
+				# convert phred scores back into a quality string, as for the other parsers
+				scores = bytes(record.letter_annotations['phred_quality'])
+				yield record.id, str(record.seq), scores.translate(phred_tab).decode()
+			else:
+				yield record.id, str(record.seq)
+		return
+		
+	# read lines in groups of four - unless we need quality scores, we only need the header and sequence lines
+	for header, seq, plus, qual in zip_longest(handle, handle, handle, handle):
+		# the last record is incomplete, unless it's just blank lines at the end of the file
+		if qual is None:
+			if "".join(line for line in (header, seq, plus) if line is not None).strip() == "":
+				return
+			raise ValueError(f"fastq record starting with line '{header.rstrip()}' is not a valid 4-line record: try running with '--parser seqio'")
+		if header[:1] != '@' or plus[:1] != '+':
+			raise ValueError(f"fastq record starting with line '{header.rstrip()}' is not a valid 4-line record: try running with '--parser seqio'")
+		if len(qual) != len(seq) and len(qual.rstrip()) != len(seq.rstrip()):
+			raise ValueError(f"fastq record starting with line '{header.rstrip()}' has a quality line of a different length to its sequence: try running with '--parser seqio'")
+		if quality is True:
+			yield header[1:].split(None, 1)[0], seq.rstrip(), qual.rstrip()
+		else:
+			yield header[1:].split(None, 1)[0], seq.rstrip()
+	
+def load_search(barcodes, args):
+	"""
+	construct the search for 'barcodes' (see construct_search), or if args.search_cache is specified,
+	load it from this directory if it was saved there by an earlier run, and save it there if not
+	
+	searches are saved in a file named after a hash of the contents of the barcodes yaml file, 
+	SEARCH_VERSION and any other arguments that change the search (see search_cache_key)
+	"""
+	if args.search_cache is None:
+		return construct_search(barcodes, args)
+		
+	filename = path.join(args.search_cache, f"{search_cache_key(args)}.pickle")
+	if path.exists(filename):
+		try:
+			with open(filename, 'rb') as handle:
+				search = pickle.load(handle)
+			print(f"loaded search for barcodes from {filename}")
+			return search
+		except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+			print(f"could not load search for barcodes from {filename}, constructing it again")
+			
+	search = construct_search(barcodes, args)
+	
+	# write to a temporary file first, so that other runs never load a partly written search
+	makedirs(args.search_cache, exist_ok = True)
+	with tempfile.NamedTemporaryFile(dir = args.search_cache, suffix = '.tmp', delete = False) as handle:
+		pickle.dump(search, handle, protocol = pickle.HIGHEST_PROTOCOL)
+	replace(handle.name, filename)
+	print(f"saved search for barcodes in {filename}")
+	
+	return search
+	
+def search_cache_key(args):
+	"""
+	get a hash of the contents of the barcodes yaml file, SEARCH_VERSION and the other arguments 
+	that change the search constructed by construct_search
+	"""
+	key = hashlib.sha256()
+	with open(args.barcodes, 'rb') as handle:
+		key.update(handle.read())
+	key.update(f"{SEARCH_VERSION}|{args.fastq2 is not None}|{np is not None}|{MAX_NEIGHBOURHOOD_SIZE}".encode())
+	return key.hexdigest()
 	
 def construct_search(barcodes, args):
 	"""
@@ -166,14 +1294,31 @@ def construct_search(barcodes, args):
 	List contains one entry for each set of barcodes
 	Each entry in the list is a dictionary, which has one key:value pair specifying the type of search, and a second containing information needed to make the search (a 'search dict')
 	
-	If the barcodes are 'variable', the 'type' is 'variable', and the search dict contains only one key:value pair:
-		the key is 'regex' and the value is the regex with capture group to use
+	If the barcodes are 'variable', the 'type' is 'variable', and the search dict contains searches for the sequences 
+		'before' and 'after' the variable region (see create_flank_search), whether or not to translate it ('trans'),
+		and the number of most frequent insertions to keep ('top_k', or None to keep all of them)
 		
 	If the barcodes are 'constant', and no mismatches are allowed, the 'type' is 'constant_exact', and the search dict
-		contains the barcodes where the barcode names are the keys and the barcode sequences are the values
+		contains the barcodes where the barcode names are the keys and the barcode sequences are the values,
+		as well as an 'index' where the barcode sequences are the keys and the barcode names are the values
 		
 	If the barcodes are 'constant' and mistmatches are allowed, the 'type' is 'constant_regex' and the search dict
 		contains the barcode names as keys and regexes used to search for the barcodes as values
+		
+	If the barcodes are 'constant', mismatches are allowed and the 'numpy' engine is used, the 'type' is 'constant_numpy',
+		and the search dict contains the barcode 'names', a 'matrix' with one row for each barcode and one column for 
+		each base, and the number of 'mismatches' allowed
+		
+	If the barcodes are 'constant', mismatches are allowed and the 'neighbourhood' engine is used, the 'type' is 
+		'constant_neighbourhood', and the search dict contains an 'index' where every sequence within 'mismatches' 
+		of a barcode is a key, and the value is the name of that barcode (or 'ambiguous' if it is within 
+		'mismatches' of more than one barcode)
+		
+	If the barcodes are 'constant' and they can be anywhere in the read ('start' is 'any') or anywhere within a
+		'tolerance' of 'start', the 'type' is 'constant_automaton' (see create_automaton_search_dict)
+		
+	All search dicts also contain the options for checking read quality (see add_quality_options), and the mate 
+	and strand of paired reads that the barcodes are found on (see add_mate_options)
 	 
 	"""
 	search = []
@@ -187,6 +1332,7 @@ def construct_search(barcodes, args):
 			search_dict = {'type':'variable'}
 			search_dict['name'] = name
 			search_dict['trans'] =  barcodes[i][name]['translate']
+			search_dict['top_k'] = barcodes[i][name].get('top_k')
 			
 			# if we allow mismatches
 			if 'mismatches' in barcodes[i][name]:
@@ -194,10 +1340,13 @@ def construct_search(barcodes, args):
 			else:
 				mismatches = 0
 			
-			# construct regex for searching
-			search_dict['forward'] = construct_variable_regex(barcodes[i][name]['before'], barcodes[i][name]['after'], mismatches)
+			# construct searches for the sequences either side of the variable region
+			search_dict['before'] = create_flank_search(barcodes[i][name]['before'], mismatches)
+			search_dict['after'] = create_flank_search(barcodes[i][name]['after'], mismatches)
 			
-			#search_dict['forward'] = f"{barcodes[i][name]['before']}(.+){barcodes[i][name]['after']}"
+			# by default, check the quality of the whole read
+			add_quality_options(search_dict, barcodes[i][name], (0, None))
+			add_mate_options(search_dict, barcodes[i][name], args)
 			search.append(search_dict)
 			
 		# if type is constant, we need to check if we are allowing mismatches or not
@@ -205,36 +1354,167 @@ def construct_search(barcodes, args):
 			# if number of mismatches is specified
 			search_dict = create_barcodes_search_dict(barcodes[i][name], args)
 			search_dict['name'] = name
+			
+			# by default, check the quality of the part of the read where we expect the barcodes
+			if search_dict['start'] is None:
+				add_quality_options(search_dict, barcodes[i][name], (0, None))
+			else:
+				add_quality_options(search_dict, barcodes[i][name], (max(0, search_dict['start']), search_dict['stop']))
+			add_mate_options(search_dict, barcodes[i][name], args)
 			search.append(search_dict)
 						
 	return search
 	
-def construct_counts_access(barcs, dict_name):
-	access = dict_name
-	for barc in barcs:
-		access = access + f"['{barc}']"
-		
-	return access
+def add_quality_options(search_dict, set_dict, default_window):
+	"""
+	add the options for checking the quality of reads for a set to its search dict: the minimum mean phred 
+	score ('min_quality', or None to not check quality), the part of the read to check ('quality_window', 
+	a (start, stop) tuple where stop may be None for the end of the read) and the weight of reads below the 
+	minimum ('quality_weight', or None if the set should not be searched in these reads)
+	"""
+	search_dict['min_quality'] = set_dict.get('min_quality')
+	search_dict['quality_window'] = tuple(set_dict['quality_window']) if 'quality_window' in set_dict else default_window
+	search_dict['quality_weight'] = set_dict.get('quality_weight')
 	
-def construct_variable_regex(before, after, mismatches):
+def add_mate_options(search_dict, set_dict, args):
 	"""
-	Construct regex to search for variable barcodes with desired number of mismatches
-	This takes the form {before}(.*){after}
+	add the mate (1 or 2) and strand ('forward' or 'reverse') of paired reads on which the barcodes in a set 
+	are found to its search dict ('mate' and 'strand').  These can only be specified for paired reads
 	"""
+	search_dict['mate'] = set_dict.get('mate', 1)
+	search_dict['strand'] = set_dict.get('strand', 'forward')
+	if args.fastq2 is None and (search_dict['mate'], search_dict['strand']) != (1, 'forward'):
+		raise ValueError(f"mate and strand of set {search_dict['name']} can only be specified for paired reads (--fastq2)")
+	
+def create_flank_search(flank, mismatches):
+	"""
+	Create a dictionary specifying how to find the sequence 'flank' in a read, allowing up to 'mismatches' mismatches
+	
+	The flank is split into mismatches + 1 'pieces', at least one of which must occur exactly wherever the flank
+	occurs with at most 'mismatches' mismatches.  The 'masks' are bitmasks for every combination of positions at 
+	which mismatches are allowed, equivalent to the alternatives in the regex created by create_mismatches_regex
+	"""
+	flank = flank.lower()
+	search_dict = {'seq':flank, 'mismatches':mismatches}
+	
+	# if the flank is too short to split into pieces, every position in the read must be checked
+	if mismatches + 1 > len(flank):
+		search_dict['pieces'] = None
+	else:
+		bounds = [i * len(flank) // (mismatches + 1) for i in range(mismatches + 2)]
+		search_dict['pieces'] = [(bounds[i], flank[bounds[i]:bounds[i + 1]]) for i in range(mismatches + 1)]
+	
 	if mismatches == 0:
-		return f"{before}(.*){after}"
+		search_dict['masks'] = [0]
+	else:
+		search_dict['masks'] = [sum([1 << i for i in positions]) 
+									for n in range(1, min(mismatches, len(flank)) + 1) 
+									for positions in combinations(range(len(flank)), n)]
 	
-	# get a regex for a mismatch in every place in before and after sequences
-	befores = create_mismatches_regex([before], mismatches)
-	afters = create_mismatches_regex([after], mismatches)
+	return search_dict
+	
+def locate_flank(line, flank, start = 0):
+	"""
+	Find all the places at or after 'start' where the flank specified by 'flank' (from create_flank_search) occurs 
+	in 'line' (which must be lowercase) with at most flank['mismatches'] mismatches
+	Returns a list of tuples of the position and a bitmask of the mismatched bases, in order of position
+	"""
+	seq = flank['seq']
+	length = len(seq)
+	
+	# find candidate positions using the pieces of the flank
+	if flank['pieces'] is None:
+		candidates = range(start, len(line) - length + 1)
+	else:
+		candidates = set()
+		for offset, piece in flank['pieces']:
+			i = line.find(piece, start + offset)
+			while i != -1:
+				if i - offset <= len(line) - length:
+					candidates.add(i - offset)
+				i = line.find(piece, i + 1)
+		candidates = sorted(candidates)
+		
+	if flank['mismatches'] == 0:
+		return [(position, 0) for position in candidates]
+	
+	# check mismatches at each candidate position
+	hits = []
+	for position in candidates:
+		mask = 0
+		n_mismatches = 0
+		for i in range(length):
+			if line[position + i] != seq[i]:
+				mask |= 1 << i
+				n_mismatches += 1
+				if n_mismatches > flank['mismatches']:
+					break
+		if n_mismatches <= flank['mismatches']:
+			hits.append((position, mask))
+			
+	return hits
+	
+def allowed_flank_positions(hits, masks):
+	"""
+	For each combination of positions at which mismatches are allowed (bitmasks in 'masks'), get the positions 
+	in 'hits' (from locate_flank) where the flank matches.  Returns a list of the distinct non-empty lists of positions
+	"""
+	# exact matches are allowed for every combination
+	if all([mask == 0 for position, mask in hits]):
+		return [[position for position, mask in hits]]
+	
+	allowed = []
+	for allowed_mask in masks:
+		positions = [position for position, mask in hits if mask & ~allowed_mask == 0]
+		if len(positions) > 0 and positions not in allowed:
+			allowed.append(positions)
+	return allowed
+	
+def find_insertion(line, set, lowered = None):
+	"""
+	Find the sequence between the 'before' and 'after' flanks of a 'variable' set in 'line'.  'lowered' is 'line' 
+	in lowercase, if it's already known
+	
+	For each combination of allowed mismatches in each flank, the insertion runs from the first occurrence of the 
+	'before' flank to the last occurrence of the 'after' flank following it (as for a greedy regex {before}(.*){after})
+	
+	Returns a tuple of the type of match and the insertion.  The type is 'insertion' if exactly one insertion was found,
+	'ambiguous' if more than one was found, 'no_insertion' if both flanks were found but there was nothing between them, 
+	and 'none' if the flanks couldn't be found
+	"""
+	if lowered is None:
+		lowered = line.lower()
+	befores = locate_flank(lowered, set['before'])
+	if len(befores) == 0:
+		return 'none', None
+	
+	# only 'after' flanks following the first 'before' flank can end an insertion
+	before_length = len(set['before']['seq'])
+	afters = locate_flank(lowered, set['after'], befores[0][0] + before_length)
+	if len(afters) == 0:
+		if len(locate_flank(lowered, set['after'])) == 0:
+			return 'none', None
+		return 'no_insertion', None
+	
+	matches = []
+	for before_positions in allowed_flank_positions(befores, set['before']['masks']):
+		for after_positions in allowed_flank_positions(afters, set['after']['masks']):
+			for start in before_positions:
+				ends = [end for end in after_positions if end >= start + before_length]
+				if len(ends) > 0:
+					match = line[start + before_length:max(ends)]
+					if match not in matches:
+						matches.append(match)
+					break
+	
+	# if we found both flanks, but there's nothing between them
+	if (len(matches) == 0) or (matches[0] == "" and len(matches) == 1):
+		return 'no_insertion', None
+	elif len(matches) == 1:
+		return 'insertion', matches[0]
+	else:
+		return 'ambiguous', None
 	
-	# combine each before and after regex with (.+) in the middle
-	regexes = []
-	for b in befores.split("|"):
-		for a in afters.split("|"):
-			regexes.append(f"{b}(.*){a}")
-	return "|".join(regexes)
-
 def create_barcodes_search_dict(barcodes_dict, args):
 	"""
 	create a dictionary of barcodes for constructing a search
@@ -246,28 +1526,252 @@ def create_barcodes_search_dict(barcodes_dict, args):
 	#get dictionary with names:seq for barcodes
 	forward_barcs = barcodes_dict['barcodes']
 	
-	# get expected start and stop for barcodes
-	search_dict['start'] = barcodes_dict['start']
-	search_dict['stop'] = search_dict['start'] + len(list(forward_barcs.values())[0])
-	
 	# get number of mismatches
 	if 'mismatches' in barcodes_dict:
 		mismatches = barcodes_dict['mismatches']
 	else:
 		mismatches = 0
+		
+	# if the barcodes can be anywhere in the read, or anywhere in a window, search for them with an automaton
+	if barcodes_dict['start'] == 'any' or 'tolerance' in barcodes_dict:
+		return create_automaton_search_dict(barcodes_dict, mismatches)
+	
+	# get expected start and stop for barcodes
+	search_dict['start'] = barcodes_dict['start']
+	search_dict['stop'] = search_dict['start'] + len(list(forward_barcs.values())[0])
 	
 	# construct dictionary for regexes/exact matches
 	if mismatches == 0:
 		# if not allowing mismatches, just use sequences from yaml file
 		search_dict['type'] = 'constant_exact'
 		search_dict['forward_search'] = {f"{key} ({value})":value for key, value in forward_barcs.items()}
+		# reverse lookup from sequence to name, so that each read only needs one lookup
+		# if a sequence appears more than once, the first name is used
+		search_dict['index'] = {}
+		for name, barcode in search_dict['forward_search'].items():
+			search_dict['index'].setdefault(barcode, name)
 	if mismatches > 0:
-		# if allowing mismatches, use regexes
-		search_dict['type'] = 'constant_regex'
-		search_dict['forward_search'] = {f"{key} ({value})":create_mismatches_regex([value], mismatches) for key, value in forward_barcs.items()}
+		engine = barcodes_dict.get('engine', 'auto')
+		if engine == 'auto':
+			engine = choose_constant_engine(forward_barcs, mismatches)
+			
+		if engine == 'numpy':
+			# if allowing mismatches, compare reads to a matrix of barcodes
+			if np is None:
+				raise ValueError("numpy must be installed to use the 'numpy' engine")
+			search_dict['type'] = 'constant_numpy'
+			search_dict['names'] = [f"{key} ({value})" for key, value in forward_barcs.items()]
+			search_dict['matrix'] = encode_sequences([value.translate(neighbourhood_tab) for value in forward_barcs.values()])
+			search_dict['mismatches'] = mismatches
+		elif engine == 'neighbourhood':
+			# if allowing mismatches, precompute all sequences within 'mismatches' of each barcode
+			search_dict['type'] = 'constant_neighbourhood'
+			search_dict['index'] = create_neighbourhood_index({f"{key} ({value})":value for key, value in forward_barcs.items()}, mismatches)
+		else:
+			# if allowing mismatches, use regexes
+			search_dict['type'] = 'constant_regex'
+			search_dict['forward_search'] = {f"{key} ({value})":create_mismatches_regex([value], mismatches) for key, value in forward_barcs.items()}
 		
 	return search_dict
 	
+def create_automaton_search_dict(barcodes_dict, mismatches):
+	"""
+	create a search dict for a set of constant barcodes that may start anywhere in the read ('start' is 'any'),
+	or anywhere within 'tolerance' bases of 'start'
+	
+	the 'type' is 'constant_automaton', and the search dict contains the 'start' and 'stop' of the part of the
+	read to search (both None for the whole read), and an Aho-Corasick 'automaton' (see create_automaton) 
+	containing each barcode, or each sequence within 'mismatches' of a barcode
+	"""
+	forward_barcs = barcodes_dict['barcodes']
+	length = len(list(forward_barcs.values())[0])
+	search_dict = {'type':'constant_automaton'}
+	if barcodes_dict['start'] == 'any':
+		search_dict['start'] = None
+		search_dict['stop'] = None
+	else:
+		search_dict['start'] = barcodes_dict['start'] - barcodes_dict['tolerance']
+		search_dict['stop'] = barcodes_dict['start'] + length + barcodes_dict['tolerance']
+		
+	names = {f"{key} ({value})":value for key, value in forward_barcs.items()}
+	if mismatches == 0:
+		# as for exact matches at a fixed position, matches are case-sensitive, and if a sequence appears 
+		# more than once the first name is used
+		patterns = {}
+		for name, barcode in names.items():
+			patterns.setdefault(barcode.translate(exact_tab), name)
+		search_dict['automaton'] = create_automaton(patterns, EXACT_ALPHABET, exact_tab)
+	else:
+		if neighbourhood_size(length, mismatches) * len(forward_barcs) > MAX_AUTOMATON_SIZE:
+			raise ValueError(f"too many sequences are within {mismatches} mismatches of the barcodes to search for them anywhere in the read: please allow fewer mismatches")
+		search_dict['automaton'] = create_automaton(create_neighbourhood_index(names, mismatches))
+	
+	return search_dict
+	
+def create_automaton(patterns, alphabet = NEIGHBOURHOOD_ALPHABET, tab = neighbourhood_tab):
+	"""
+	build an Aho-Corasick automaton for finding the sequences that are the keys of 'patterns' (which must all 
+	be the same length, and only contain letters in 'alphabet') in a single pass over a read, after translating 
+	it with 'tab' (which must translate every letter into one in 'alphabet')
+	
+	returns a dictionary with the transitions between states for each letter ('delta', a list with a dictionary
+	for each state), the value in 'patterns' for the sequence that ends at each state ('output', a list with 
+	None for states at which no sequence ends), and the table to translate reads with ('tab').  The initial 
+	state is 0
+	"""
+	# build a trie of the sequences
+	goto = [{}]
+	output = [None]
+	for sequence, value in patterns.items():
+		state = 0
+		for char in sequence:
+			if char not in goto[state]:
+				goto[state][char] = len(goto)
+				goto.append({})
+				output.append(None)
+			state = goto[state][char]
+		output[state] = value
+		
+	# add failure transitions, in breadth-first order so that the failure state of each state (which is 
+	# shallower in the trie) is complete before the state itself.  Because all the sequences are the same 
+	# length, no sequence ends at the failure state of a state where another sequence ends, so there is at 
+	# most one output for each state
+	delta = [{} for state in goto]
+	fail = [0] * len(goto)
+	queue = deque()
+	for char in alphabet:
+		delta[0][char] = goto[0].get(char, 0)
+		if char in goto[0]:
+			queue.append(goto[0][char])
+	while len(queue) > 0:
+		state = queue.popleft()
+		for char in alphabet:
+			if char in goto[state]:
+				next_state = goto[state][char]
+				fail[next_state] = delta[fail[state]][char]
+				delta[state][char] = next_state
+				queue.append(next_state)
+			else:
+				delta[state][char] = delta[fail[state]][char]
+				
+	return {'delta':delta, 'output':output, 'tab':tab}
+	
+def match_constant_automaton(line, set, offset = 0):
+	"""
+	find the barcodes in a 'constant_automaton' set in 'line', in the part of the read from set['start'] 
+	to set['stop'] shifted by 'offset' (or the whole read, if set['start'] is None)
+	
+	returns the name of the barcode found, 'none' if no barcodes were found, or 'ambiguous' if more than one 
+	barcode was found (a barcode found more than once is not ambiguous)
+	"""
+	if set['start'] is not None:
+		start = max(0, set['start'] + offset)
+		line = line[start:max(start, set['stop'] + offset)]
+		
+	delta = set['automaton']['delta']
+	output = set['automaton']['output']
+	state = 0
+	found = 'none'
+	for char in line.translate(set['automaton']['tab']):
+		state = delta[state][char]
+		if output[state] is not None and output[state] != found:
+			if found != 'none':
+				return 'ambiguous'
+			found = output[state]
+	return found
+	
+def choose_constant_engine(forward_barcs, mismatches):
+	"""
+	choose an engine for matching constant barcodes with mismatches: use a neighbourhood index
+	unless it would have more than MAX_NEIGHBOURHOOD_SIZE entries, otherwise use numpy if it's 
+	installed, and regexes if it isn't
+	"""
+	if neighbourhood_size(len(list(forward_barcs.values())[0]), mismatches) * len(forward_barcs) <= MAX_NEIGHBOURHOOD_SIZE:
+		return 'neighbourhood'
+	if np is not None:
+		return 'numpy'
+	return 'regex'
+	
+def neighbourhood_size(length, mismatches):
+	"""
+	number of sequences within 'mismatches' of a sequence of length 'length'
+	"""
+	substitutions = len(NEIGHBOURHOOD_ALPHABET) - 1
+	return sum([comb(length, i) * substitutions ** i for i in range(mismatches + 1)])
+	
+def create_neighbourhood(sequence, mismatches):
+	"""
+	Create a set of all the sequences with at most 'mismatches' mismatches to 'sequence'
+	""" 
+	neighbours = set()
+	for positions in combinations(range(len(sequence)), mismatches):
+		for letters in product(NEIGHBOURHOOD_ALPHABET, repeat = mismatches):
+			neighbour = list(sequence)
+			for position, letter in zip(positions, letters):
+				neighbour[position] = letter
+			neighbours.add("".join(neighbour))
+	return neighbours
+	
+def encode_sequences(sequences):
+	"""
+	Encode a list of sequences, which must all be the same length, as a numpy array of bytes 
+	with one row for each sequence
+	"""
+	length = len(sequences[0]) if len(sequences) > 0 else 0
+	buffer = "".join(sequences).encode('ascii', errors = 'replace')
+	return np.frombuffer(buffer, dtype = np.uint8).reshape(len(sequences), length)
+	
+def match_constant_numpy(lines, set, offsets):
+	"""
+	Find the barcodes in a 'constant_numpy' set in each sequence in 'lines', with the start of the barcodes
+	shifted by the corresponding element of 'offsets'
+	Returns a list with the name of the barcode found in each line, or 'none' if no barcodes are within
+	the allowed number of mismatches, or 'ambiguous' if more than one barcode is
+	"""
+	length = set['stop'] - set['start']
+	barcodes = set['matrix']
+	
+	# get part of each read to check - reads that are too short don't match any barcode
+	subreads = [get_subread(line, set, offset).translate(neighbourhood_tab) for line, offset in zip(lines, offsets)]
+	valid = [i for i, subread in enumerate(subreads) if len(subread) == length]
+	reads = encode_sequences([subreads[i] for i in valid])
+	
+	# count the number of barcodes within 'mismatches' of each read, and the first one that is
+	n_close = np.zeros(len(reads), dtype = np.int64)
+	first_close = np.zeros(len(reads), dtype = np.int64)
+	step = max(1, NUMPY_BATCH_CELLS // len(barcodes))
+	dtype = np.uint8 if length < 256 else np.uint32
+	for i in range(0, len(reads), step):
+		batch = reads[i:i + step]
+		distances = np.zeros((len(batch), len(barcodes)), dtype = dtype)
+		for position in range(length):
+			distances += batch[:, position, None] != barcodes[None, :, position]
+		close = distances <= set['mismatches']
+		n_close[i:i + step] = close.sum(axis = 1)
+		first_close[i:i + step] = close.argmax(axis = 1)
+	
+	matches = ['none'] * len(lines)
+	for i, n, first in zip(valid, n_close.tolist(), first_close.tolist()):
+		if n == 1:
+			matches[i] = set['names'][first]
+		elif n > 1:
+			matches[i] = 'ambiguous'
+	return matches
+	
+def create_neighbourhood_index(forward_search, mismatches):
+	"""
+	Create a dictionary where the keys are all the sequences within 'mismatches' of each barcode in 'forward_search',
+	and the values are the name of the barcode, or 'ambiguous' if a sequence is close to more than one barcode
+	"""
+	index = {}
+	for name, barcode in forward_search.items():
+		for neighbour in create_neighbourhood(barcode.translate(neighbourhood_tab), mismatches):
+			if index.get(neighbour, name) != name:
+				index[neighbour] = 'ambiguous'
+			else:
+				index[neighbour] = name
+	return index
+	
 def create_mismatches_regex(sequence_list, mismatches):
 	"""
 	Create regex consisting that will match the 'sequence' with 'mismatches' number of mismatches
@@ -284,58 +1788,142 @@ def create_mismatches_regex(sequence_list, mismatches):
 		# then call the function with one fewer mismatches
 		return create_mismatches_regex(new_sequence_list, mismatches - 1)
 		
-def create_level(dict, path_list, value):
+def get_subread(line, set, offset = 0):
 	"""
-	create new level in nested dictionary, and initialise to value
+	get the part of 'line' where we expect to find the barcodes in a constant set, shifted by 'offset'
+	if this would start before the beginning of the read, return an empty string
 	"""
-	if len(path_list) == 0:
-		return
-
-	for k in path_list[:-1]:
-		dict = dict[k]
+	start = set['start'] + offset
+	if start < 0:
+		return ""
+	return line[start:set['stop'] + offset]
+	
+def find_barcodes_in_lines(lines, search, offsets = None, rejected = None):
+	"""
+	look for the barcodes specified in 'search' in each of the sequences in 'lines'
+	return a list with a list of the names of the barcodes found in each line
 	
-	dict[path_list[-1]] = value
+	if 'offsets' are specified, the start of constant barcodes in each line is shifted by the corresponding offset
+	
+	if 'rejected' is specified, it contains a tuple for each line of the names of sets that are not searched
+	in that line (because of low quality), for which the result is LOW_QUALITY
+	
+	sets of type 'constant_numpy' are checked in all the lines at once, and the other 
+	sets are checked one line at a time
+	"""
+	if offsets is None:
+		offsets = [0] * len(lines)
+	if rejected is None:
+		rejected = [()] * len(lines)
+		
+	batched = [i for i, set in enumerate(search) if set['type'] == 'constant_numpy']
+	if len(batched) == 0:
+		return [find_barcodes_in_line(line, search, offset, line_rejected) for line, offset, line_rejected in zip(lines, offsets, rejected)]
+	
+	batch_matches = {}
+	for i in batched:
+		# only check lines in which this set was not rejected
+		checked = [j for j in range(len(lines)) if search[i]['name'] not in rejected[j]]
+		batch_matches[i] = [LOW_QUALITY] * len(lines)
+		matches = match_constant_numpy([lines[j] for j in checked], search[i], [offsets[j] for j in checked])
+		for j, match in zip(checked, matches):
+			batch_matches[i][j] = match
+	others = [set for set in search if set['type'] != 'constant_numpy']
+	
+	found = []
+	for j, line in enumerate(lines):
+		found_barcodes = find_barcodes_in_line(line, others, offsets[j], rejected[j])
+		for i in batched:
+			found_barcodes.insert(i, batch_matches[i][j])
+		found.append(found_barcodes)
+	return found
 			
-def find_barcodes_in_line(line, search):
+def group_sets_by_view(search):
+	"""
+	group the sets in 'search' by the mate and strand of paired reads that they are found on ('mate' and 'strand')
+	
+	returns a dictionary with a (mate, strand) tuple as each key, and a list of the indices of the sets in
+	'search' on that mate and strand as the values
+	"""
+	views = {}
+	for i, set in enumerate(search):
+		views.setdefault((set['mate'], set['strand']), []).append(i)
+	return views
+	
+def pair_view(pair, mate, strand, complement = True):
+	"""
+	get one mate (1 or 2) from a pair of oriented reads, reverse complemented if strand is 'reverse'
+	
+	if 'complement' is False (for quality strings), the mate is only reversed
+	"""
+	if strand == 'reverse' and complement is True:
+		return pair[mate - 1].translate(tab)[::-1]
+	if strand == 'reverse':
+		return pair[mate - 1][::-1]
+	return pair[mate - 1]
+	
+def find_barcodes_in_pairs(pairs, search, offsets = None, rejected = None):
+	"""
+	look for the barcodes specified in 'search' in each of the oriented (seq1, seq2) pairs of reads in 'pairs'
+	return a list with a list of the names of the barcodes found in each pair
+	
+	each set is searched for in the mate and strand given by its 'mate' and 'strand' (see find_barcodes_in_lines).  
+	'offsets' only shift sets on the forward strand of the first mate, which is the mate the primer was found in
+	"""
+	found = [[None] * len(search) for pair in pairs]
+	for (mate, strand), indices in group_sets_by_view(search).items():
+		lines = [pair_view(pair, mate, strand) for pair in pairs]
+		view_offsets = offsets if (mate, strand) == (1, 'forward') else None
+		view_found = find_barcodes_in_lines(lines, [search[i] for i in indices], view_offsets, rejected)
+		for pair_found, pair_view_found in zip(found, view_found):
+			for i, barc in zip(indices, pair_view_found):
+				pair_found[i] = barc
+	return found
+	
+def find_barcodes_in_line(line, search, offset = 0, rejected = ()):
 	"""
 	look for the barcodes specified in 'search' in the sequence 'line'
 	return a list of the names of the barcodes found
+	
+	the start of constant barcodes is shifted by 'offset' (for example, if the forward primer was found
+	at a different position to that expected)
+	
+	sets with names in 'rejected' are not searched, and the result for these sets is LOW_QUALITY
 	"""
 	# iterate over sets to search for
 	found_barcodes = []
+	lowered = None
 	for set in search:
-		if set['type'] == 'constant_exact':
-			matches = []
+		if set['name'] in rejected:
+			found_barcodes.append(LOW_QUALITY)
+			
+		elif set['type'] == 'constant_exact':
 			# get part of read to check
-			start = set['start']
-			stop = set['stop']
-			subread_forward = line[start:stop]
+			subread_forward = get_subread(line, set, offset)
 			
 			# check if the subread matches any of the barcodes
-			for name, barcode in set['forward_search'].items():
-				assert len(barcode) == len(subread_forward)
-				
-				if barcode == subread_forward:
-					matches.append(name)
-					# for exact match, can only find one barcode
-					break
+			found_barcodes.append(set['index'].get(subread_forward, 'none'))
 			
-			# check how many matches we found
-			if not(len(matches) == 0 or len(matches) == 1):
-				pdb.set_trace()
-			assert (len(matches) == 0 or len(matches) == 1)
-			if len(matches) == 0:
-				found_barcodes.append('none')
-			elif len(matches) == 1:
-				found_barcodes.append(matches[0])
+		elif set['type'] == 'constant_numpy':
+			# check if the subread is close to one or more of the barcodes
+			found_barcodes.append(match_constant_numpy([line], set, [offset])[0])
+			
+		elif set['type'] == 'constant_automaton':
+			# look for the barcodes anywhere in the read (or the part of it where they're allowed to be)
+			found_barcodes.append(match_constant_automaton(line, set, offset))
+			
+		elif set['type'] == 'constant_neighbourhood':
+			# get part of read to check
+			subread_forward = get_subread(line, set, offset).translate(neighbourhood_tab)
+			
+			# check if the subread is close to one or more of the barcodes
+			found_barcodes.append(set['index'].get(subread_forward, 'none'))
 			
 		elif set['type'] == 'constant_regex':
 			matches = []
 			
 			# get part of read to check
-			start = set['start']
-			stop = set['stop']
-			subread_forward = line[start:stop]
+			subread_forward = get_subread(line, set, offset)
 			
 			# check if subread matches any of the barcodes
 			for name, barcode in set['forward_search'].items():
@@ -351,102 +1939,95 @@ def find_barcodes_in_line(line, search):
 				found_barcodes.append('ambiguous')
 			
 		elif set['type'] == 'variable':
-			matches = []
-			regexes =set['forward'].split("|")
-			
-			# match regexes
-			for regex in regexes:
-				match = re.findall(regex, line, re.IGNORECASE)
-				for m in match:
-					if m not in matches:
-						matches.append(m)
-						
-			# check how many matches we found
-			if (len(matches) == 0) or (matches[0] == "" and len(matches) == 1):
-				# check if there is no insertion, or we couldn't find the regex at all
-				int_type = ""
-				for regex in regexes:
-					# check if we found both the 'before' and 'after' sequence
-					before, after = regex.split('(.*)')
-					if bool(re.search(before, line, re.IGNORECASE)) and bool(re.search(after, line, re.IGNORECASE)):
-						int_type = 'no_insertion'
-						break
-				# if we didn't find a regex above, then there wasn't a match
-				if int_type == "":
-					int_type = 'none'
+			# only lowercase the read once, for all the variable sets
+			if lowered is None:
+				lowered = line.lower()
+			int_type, match = find_insertion(line, set, lowered)
+			
+			if int_type != 'insertion':
 				found_barcodes.append(int_type)
-
-			elif len(matches) == 1:
-				
-				#only try to translate if there is just one match and its length is a multiple of three
-				if set['trans']:
-					if ( len(matches[0]) % 3 ) == 0:
-						barc = str(Seq(matches[0]).translate())
-					else:
-						# otherwise just add brackets to indicate a nucleotide sequence
-						barc = f"({matches[0]})"
+			
+			#only try to translate if there is just one match and its length is a multiple of three
+			elif set['trans']:
+				if ( len(match) % 3 ) == 0:
+					found_barcodes.append(translate_insertion(match))
 				else:
-					barc = matches[0]
-				found_barcodes.append(barc)
-				
-			elif len(matches) > 1:
-				found_barcodes.append('ambiguous')	
+					# otherwise just add brackets to indicate a nucleotide sequence
+					found_barcodes.append(f"({match})")
+			else:
+				found_barcodes.append(match)
 
 	assert len(found_barcodes) == len(search)
 	return found_barcodes
 	
-def get_all_counts(counts, cur=()):
+@lru_cache(maxsize = TRANSLATION_CACHE_SIZE)
+def translate_insertion(insertion):
 	"""
-	Get all counts for all combinations of barcodes in the 'counts' nested dict
-	https://stackoverflow.com/questions/11570499/generate-all-leaf-to-root-paths-in-a-dictionary-tree-in-python
+	translate a nucleotide sequence into amino acids
+	insertion libraries contain relatively few distinct sequences, so remember the most recent translations
 	"""
-	# if we're at the end of the tree
-	if isinstance(counts, int):
-		yield cur + (counts,)
-	# otherwise, get all paths beyond current place in tree
-	else:
-		for n, s in counts.items():
-			for path in get_all_counts(s, cur+(n,)):
-				yield path
+	return str(Seq(insertion).translate())
 	
-def increment_counter(counts, found_barcs):
+def get_all_counts(counts):
 	"""
-	given a list of barcodes found in a read, and a counter dictionary
-	increment the combination of found barcodes
+	Get all counts for all combinations of barcodes in the 'counts' Counter, as tuples of
+	the barcodes in each set followed by the count
+	
+	Combinations are grouped by the barcode found in the first set, then by the barcode found 
+	in the second set, and so on, with barcodes at each level in the order they were first seen
 	"""
+	keys = list(counts)
+	levels = len(keys[0]) if len(keys) > 0 else 0
+	for key in group_keys(keys, 0, len(keys), 0, levels):
+		yield key + (format_count(counts[key]),)
+		
+def group_keys(keys, start, stop, level, levels):
+	"""
+	Group the combinations in keys[start:stop] (in place) by the barcode at 'level', with barcodes in 
+	the order they were first seen, and then group each of these groups by the next level
 	
-	assert isinstance(counts, dict)
-	assert isinstance(found_barcs, list)
+	Only one group at each level is grouped at a time, so the most memory needed is for a key for each 
+	combination at the first level (rather than for each prefix of each combination)
 	
-	# first check that all levels exist in found_barcs
-	for level, barc in enumerate(found_barcs):
-		# check that barc exists at this level
-		if barc in eval(construct_counts_access(found_barcs[:level], 'counts')):
-			pass
-		else:
-			# need to add new level if we're not at the end of the list
-			if level < len(found_barcs) - 1:
-				create_level(counts, found_barcs[:level+1], {})
-			# or create new entry if we are at the end of the list
-			else:
-				create_level(counts, found_barcs[:level+1], 0)
-				
-	# now increment counter
-	increment_value(counts, found_barcs, 1)		
+	yields the combinations in keys[start:stop] in this order
+	"""
+	if level == levels or stop - start == 1:
+		yield from keys[start:stop]
+		return
 	
+	# sort the group by the order in which barcodes were first seen (a stable sort, so that 
+	# the barcodes at the next level are also still in the order they were first seen)
+	group = keys[start:stop]
+	group_sizes = Counter(key[level] for key in group)
+	if len(group_sizes) > 1:
+		rank = {barc:i for i, barc in enumerate(group_sizes)}
+		group.sort(key = lambda key: rank[key[level]])
+		keys[start:stop] = group
+		del rank
+	del group
 	
-	return counts
+	for size in group_sizes.values():
+		yield from group_keys(keys, start, start + size, level + 1, levels)
+		start += size
+		
+def format_count(count):
+	"""
+	counts are only fractional if reads were down-weighted because of low quality (see check_read_quality), 
+	so write whole-number counts as integers
+	"""
+	if isinstance(count, float) and count.is_integer():
+		return int(count)
+	return count
 	
-def increment_value(dict, path_list, value):
+def increment_counter(counts, found_barcs, value = 1):
 	"""
-	increment value in nested dictionary
+	given a list of barcodes found in a read, and a Counter keyed by tuples of barcodes
+	increment the count for this combination of found barcodes by 'value'
 	"""
-	for k in path_list[:-1]:
-		dict = dict[k]
+	counts[tuple(found_barcs)] += value
 	
-	dict[path_list[-1]] += value
+	return counts
 		
-
 def interpret_bool(str):
 	if str is True:
 		return True
@@ -497,8 +2078,26 @@ def parse_barcs_yaml(args):
 				if 'mismatches' in barcodes[i][name]:
 					if barcodes[i][name]['mismatches'] > len(barcodes_list[0]):
 						raise ValueError(f"number of mismatches must not be greater than the length of barcodes in set {name}")
+						
+				# check that the engine used for matching barcodes with mismatches is one we know about
+				if barcodes[i][name].get('engine', 'auto') not in CONSTANT_ENGINES:
+					raise ValueError(f"engine for constant set {name} must be one of {', '.join(CONSTANT_ENGINES)}")
+					
+				# check that the start is a position, or 'any', and that the tolerance around it makes sense
+				if start != 'any' and (not isinstance(start, int) or start < 0):
+					raise ValueError(f"start of constant set {name} must be a position in the read, or 'any'")
+				if 'tolerance' in barcodes[i][name]:
+					if start == 'any':
+						raise ValueError(f"tolerance cannot be specified for constant set {name}, because it can start anywhere in the read")
+					if not isinstance(barcodes[i][name]['tolerance'], int) or barcodes[i][name]['tolerance'] < 0:
+						raise ValueError(f"tolerance for constant set {name} must be a whole number that is not negative")
 				
-				print(f"set {name} contains {num_barcs} barcodes, and starts at position {start} in read")
+				if start == 'any':
+					print(f"set {name} contains {num_barcs} barcodes, and can start anywhere in read")
+				elif 'tolerance' in barcodes[i][name]:
+					print(f"set {name} contains {num_barcs} barcodes, and starts within {barcodes[i][name]['tolerance']} bases of position {start} in read")
+				else:
+					print(f"set {name} contains {num_barcs} barcodes, and starts at position {start} in read")
 				
 			# if this set is variable, check it contains a before and after sequence
 			elif barcodes[i][name]['type'] == 'variable':
@@ -516,35 +2115,137 @@ def parse_barcs_yaml(args):
 					barcodes[i][name]['translate'] = False
 					translate = False
 				
+				# check that if only the most frequent insertions are kept, there is at least one of them
+				if 'top_k' in barcodes[i][name]:
+					if not isinstance(barcodes[i][name]['top_k'], int) or barcodes[i][name]['top_k'] < 1:
+						raise ValueError(f"top_k for variable set {name} must be a positive integer")
+				
 				print(f"set {name} will consist of all the sequences occuring between sequences {before} and {after} in the read.  The sequences {'will' if translate else 'will not'} be translated into amino acid squences")
+				if 'top_k' in barcodes[i][name]:
+					print(f"only the {barcodes[i][name]['top_k']} most frequent sequences in set {name} will be counted separately")
 		except KeyError:
 			print("check barcodes yaml file is valid:")
 			print("'constant' barcode sets must contain a 'start' and a list of barcodes")
 			print("'variable' barcode sets must specify the sequence 'before' and 'after' the variable sequence")
 			raise ValueError("please specify a valid barcodes yaml")
 	
+		# check that the options for read quality make sense
+		check_quality_options(name, barcodes[i][name])
+		
+		# check that the mate and strand for paired reads make sense
+		if barcodes[i][name].get('mate', 1) not in (1, 2):
+			raise ValueError(f"mate for set {name} must be 1 or 2")
+		if barcodes[i][name].get('strand', 'forward') not in ('forward', 'reverse'):
+			raise ValueError(f"strand for set {name} must be 'forward' or 'reverse'")
+	
 	# check that there are no duplicate names		
 	if len(names) != len(set(names)):
 		raise ValueError("Please specify unique names for each barcode set")
 		
 	return barcodes
 	
+def check_quality_options(name, set_dict):
+	"""
+	check the options for checking the quality of reads for a set of barcodes
+	"""
+	if 'min_quality' in set_dict:
+		if not isinstance(set_dict['min_quality'], (int, float)) or set_dict['min_quality'] < 0:
+			raise ValueError(f"min_quality for set {name} must be a number that is not negative")
+		print(f"reads with a mean quality below {set_dict['min_quality']} in set {name} will be {'down-weighted' if 'quality_weight' in set_dict else 'counted as ' + LOW_QUALITY}")
+	elif 'quality_window' in set_dict or 'quality_weight' in set_dict:
+		raise ValueError(f"please specify min_quality for set {name} to use quality_window or quality_weight")
+	
+	if 'quality_window' in set_dict:
+		window = set_dict['quality_window']
+		if not isinstance(window, list) or len(window) != 2 or not all([isinstance(i, int) for i in window]) or window[0] >= window[1]:
+			raise ValueError(f"quality_window for set {name} must be a list of a start and a (larger) stop")
+			
+	if 'quality_weight' in set_dict:
+		if not isinstance(set_dict['quality_weight'], (int, float)) or not 0 < set_dict['quality_weight'] <= 1:
+			raise ValueError(f"quality_weight for set {name} must be greater than 0 and at most 1")
+	
 def reverse_complement(seq):
 	# check for bases not recgonised
 	for base in seq:
 		assert base in old_chars
 	return seq.translate(tab)[::-1]
 		
-def write_counts(outfile, counts, search):
+def write_counts(outfile, counts, search, chunk_size = WRITE_CHUNK_SIZE):
 	"""
-	Write counts in recursive dictionary 'counts' as pandas data frame to file 'outfile'
+	Write counts in Counter 'counts' to file 'outfile', 'chunk_size' rows at a time
+	
+	The output is a tab-separated table (gzipped if 'outfile' ends in .gz), or a parquet file
+	(if 'outfile' ends in .parquet) in which the column for each set is dictionary-encoded
+	
+	returns a list with a Counter for each set, of the total count for each barcode in that set
+	(the marginal counts), which are added up as the rows are written
+	"""
+	
+	columns = [set['name'] for set in search] + ['count']
+	marginals = [Counter() for set in search]
+	chunks = (add_marginals(marginals, chunk) for chunk in chunk_reads(get_all_counts(counts), chunk_size))
+	
+	if outfile.endswith('.parquet'):
+		# counts are only fractional if reads were down-weighted because of low quality
+		count_type = pa.float64() if any([isinstance(count, float) for count in counts.values()]) else pa.int64()
+		schema = pa.schema([(column, pa.dictionary(pa.int32(), pa.string())) for column in columns[:-1]] + [('count', count_type)])
+		with pq.ParquetWriter(outfile, schema) as writer:
+			for chunk in chunks:
+				values = list(zip(*chunk))
+				arrays = [pa.array(values[i], type = pa.string()).dictionary_encode() for i in range(len(columns) - 1)]
+				arrays.append(pa.array(values[-1], type = count_type))
+				writer.write_table(pa.Table.from_arrays(arrays, schema = schema))
+		return marginals
+	
+	encoding = guess_type(outfile)[1]
+	_open = partial(gzip.open, mode = 'wt', newline = '') if encoding == 'gzip' else partial(open, mode = 'w', newline = '')
+	with _open(outfile) as handle:
+		writer = csv.writer(handle, delimiter = '\t', lineterminator = '\n')
+		writer.writerow(columns)
+		for chunk in chunks:
+			writer.writerows(chunk)
+			
+	return marginals
+	
+def add_marginals(marginals, rows):
 	"""
+	add the count in each row from get_all_counts to the count for each of its barcodes in 'marginals', 
+	a list with a Counter for each set
 	
-	combinations = get_all_counts(counts)
+	returns the rows unchanged
+	"""
+	for row in rows:
+		count = row[-1]
+		for set_counts, barc in zip(marginals, row[:-1]):
+			set_counts[barc] += count
+	return rows
 	
-	counts_df = pd.DataFrame(combinations, columns = [set['name'] for set in search] + ['count'])
+def write_marginals(folder, marginals, search, top_k = None):
+	"""
+	write a table of the counts for each set (from write_counts) to a file named after the set in 'folder'
 	
-	counts_df.to_csv(outfile, index=False, sep = '\t')
+	for sets in 'top_k' (from new_top_k), the table also contains the most that each count can be lower 
+	(or, for OTHER_INSERTIONS, higher) than the true count
+	"""
+	makedirs(folder, exist_ok = True)
+	errors = {set_top_k['index']:set_top_k for set_top_k in (top_k or [])}
+	for i, (set, set_counts) in enumerate(zip(search, marginals)):
+		with open(path.join(folder, f"{set['name']}_counts.txt"), 'w', newline = '') as handle:
+			writer = csv.writer(handle, delimiter = '\t', lineterminator = '\n')
+			if i not in errors:
+				writer.writerow([set['name'], 'count'])
+				writer.writerows([(barc, format_count(count)) for barc, count in set_counts.items()])
+				continue
+			max_error = errors[i]['max_error']
+			writer.writerow([set['name'], 'count', 'max_error'])
+			for barc, count in set_counts.items():
+				count = format_count(count)
+				if barc in VARIABLE_CATEGORIES:
+					writer.writerow([barc, count, 0])
+				elif barc == OTHER_INSERTIONS:
+					writer.writerow([barc, count, max_error * len(errors[i]['counters'])])
+				else:
+					writer.writerow([barc, count, max_error])
 	
 	
 